@@ -1,12 +1,18 @@
 #!/usr/bin/python
 # -*- coding: utf8 -*-
 import ssh
-import logging
+import local
+import remote
 import os
-import sys
+import pipes
+import shutil
+import socket
 import time
-import signal
-from subprocess import Popen, PIPE
+import logging
+import threading
+from contextlib import contextmanager
+import syncplan
+from helpers import chunk_arguments
 
 class YaraptException(Exception):
     pass
@@ -19,15 +25,35 @@ class TimeoutException(YaraptException):
 class LogException(YaraptException):
     pass
 
-class AptMachine():
+@contextmanager
+def _untraced():
+    yield
+
+class AptMachine(object):
     """ class for doing various apt related tasks """
     connection = None
+    helper = None
     sudo = False
     host = None
     simulate = False
     debug = False
     apt_executable = '/usr/bin/apt-get'
-    distribution = ''
+    APT_ARCHIVES = '/var/cache/apt/archives'
+    archive_dir = APT_ARCHIVES
+    facts = None
+    package_list = None
+    _package_index = None
+    _indexed_list = None
+    _digest = None
+    _digested_list = None
+    # echo folds the output into one line: size, mtime and md5 of the dpkg database
+    FINGERPRINT_COMMAND = "echo $(/usr/bin/stat -c '%s %Y' /var/lib/dpkg/status) $(/usr/bin/md5sum < /var/lib/dpkg/status)"
+    # newest mtime and a hash of all Release files of the apt lists
+    LISTS_COMMAND = "echo $(/usr/bin/stat -c '%Y' /var/lib/apt/lists/*Release 2>/dev/null | /usr/bin/sort -n | /usr/bin/tail -n 1) $(/bin/cat /var/lib/apt/lists/*Release 2>/dev/null | /usr/bin/md5sum)"
+    # a remote command is passed to the shell as one argument, which is limited to 128 KiB
+    MAX_COMMAND_LENGTH = 32768
+    DPKG_LOG = '/var/log/dpkg.log'
+    SELECTIONS_COMMAND = "/usr/bin/dpkg --get-selections | /usr/bin/awk '{print $1, $2};'"
 
     def __init__(self, **kwargs):
         """ baut eine verbindung auf, wahlweise per ssh oder lokal """
@@ -37,6 +63,8 @@ class AptMachine():
         self.simulate = kwargs.get('simulate')
         self.apt_executable = kwargs.get('apt_command', self.apt_executable)
         self.debug = kwargs.get('debug', False)
+        self.tracer = kwargs.get('tracer')
+        self.archive_dir = kwargs.get('archive_dir', self.APT_ARCHIVES).rstrip('/')
         if self.debug:
             log_level = logging.DEBUG
         try:
@@ -51,44 +79,59 @@ class AptMachine():
         if kwargs.get('ssh'):
             logging.info('Connecting to ssh://%s' % self.host)
             try:
-                self.connection = ssh.Connection(self.host, username=kwargs['username'], password=kwargs.get('password'), private_key=kwargs.get('private_key'), level=log_level)
+                self.connection = ssh.Connection(self.host, username=kwargs['username'], password=kwargs.get('password'), private_key=kwargs.get('private_key'), port=kwargs.get('port', 22), level=log_level)
             except Exception, ex:
                 logging.error('Could not connect to %s@%s: %s' % (kwargs['username'], self.host, ex))
                 raise SSHException('Could not connect to %s@%s: %s' % (kwargs['username'], self.host, ex))
+            if kwargs.get('helper'):
+                self.start_helper()
+
+    def start_helper(self):
+        """ startet den entfernten helfer, ohne python auf dem rechner geht es mit einzelnen befehlen weiter """
+        helper = remote.RemoteHelper(self.connection)
         try:
-            self.distribution = self._execute('/usr/bin/lsb_release -ds')
-        except Exception:
-            pass
+            helper.start()
+            self.helper = helper
+        except Exception, ex:
+            helper.close()
+            logging.warn('Remote helper on host %s not available, using plain commands: %s' % (self.host, ex))
 
-    def _execute_local(self, command, timeout=60):
-        proc = Popen(command, shell=True, stdout=PIPE, stderr=PIPE, stdin=PIPE)
-        # poll for terminated status till timeout is reached
+    def _trace(self, command, start_time, stdout, stderr, returncode):
+        if self.tracer:
+            self.tracer.command(self.host, command, time.time() - start_time, len(stdout) + len(stderr), returncode)
+
+    def _execute_local(self, command, timeout=60, callback=None, stdin=None):
         start_time = time.time()
-        duration = 0
-        while True:
-            if proc.poll() is not None:
-                break
-            duration = time.time() - start_time
-            if timeout and duration > timeout:
-                os.kill(proc.pid, signal.SIGKILL)
-                raise TimeoutException('Command "%s" on host %s timed out after %d seconds.\n%s' % (command, self.host, timeout, proc.stdout.read().strip()))
-                break
-            time.sleep(0.1)
-        stdout, stderr = proc.communicate()
-        returncode = proc.returncode
+        stdout, stderr, returncode = local.execute(command, timeout, callback, stdin)
+        self._trace(command, start_time, stdout, stderr, returncode)
+        if returncode is None:
+            raise TimeoutException('Command "%s" on host %s timed out after %d seconds.\n%s' % (command, self.host, timeout, stdout.strip()))
         if returncode > 0:
             raise ShellException('Command "%s" on host %s returned %d, messages:\n%s' % (command, self.host, returncode, stderr.strip()))
         if stderr:
             logging.warn('Got error output for command %r on host %s:\n %s' % (command, self.host, stderr.strip()))
         return stdout.strip()
 
-    def _execute_ssh(self, command, timeout=15):
-        stdout, stderr = self.connection.execute(command, timeout)
-        if stdout:
-            stdout = stdout.strip()
-        if stderr:
-            stderr = stderr.strip()
-        returncode = self.connection.returncode
+    def _run_helper(self, command, timeout=15, stdin=None):
+        """ ein befehl über den entfernten helfer, liefert (stdout, stderr, returncode) """
+        try:
+            result = self.helper.request('run', timeout, command=command, stdin=stdin)
+        except socket.timeout:
+            return '', '', None
+        except remote.HelperError, ex:
+            raise ShellException('Remote helper on host %s failed for command "%s": %s' % (self.host, command, ex))
+        return result['stdout'], result['stderr'], result['returncode']
+
+    def _execute_ssh(self, command, timeout=15, callback=None, stdin=None):
+        start_time = time.time()
+        if self.helper and self.helper.channel and not callback:
+            # live output needs a channel of its own
+            stdout, stderr, returncode = self._run_helper(command, timeout or None, stdin)
+        else:
+            stdout, stderr, returncode = self.connection.run(command, timeout, callback, stdin)
+        self._trace(command, start_time, stdout, stderr, returncode)
+        stdout = stdout.strip()
+        stderr = stderr.strip()
         if returncode is None:
             raise TimeoutException('Command "%s" on host %s timed out after %d seconds.\n%s' % (command, self.host, timeout, stdout))
         if returncode > 0:
@@ -98,92 +141,305 @@ class AptMachine():
         output = stdout.strip()
         return output
 
-    def _execute(self, command):
-        """ führt einen beliebigen befehl aus, wahlweise per ssh oder lokal """
+    def _execute(self, command, callback=None, stdin=None, timeout=None):
+        """ führt einen beliebigen befehl aus, wahlweise per ssh oder lokal
+            callback(stream, line) bekommt die ausgabe zeilenweise, während der befehl läuft,
+            stdin wird dem befehl als eingabe geschickt, timeout=0 wartet beliebig lange """
+        limit = dict()
+        if timeout is not None:
+            limit['timeout'] = timeout
         command = command.strip()
         if self.connection:
-            if self.sudo:
-                command = 'sudo %s' % command
+            command = self._remote_command(command)
             if self.debug:
                 print '[DEBUG] Executing ssh command %r' % command
             logging.info('Executing ssh command %r' % command)
-            return self._execute_ssh(command)
+            return self._execute_ssh(command, callback=callback, stdin=stdin, **limit)
         else:
             if self.sudo:
                 command = 'sudo "%s"' % command
             if self.debug:
                 print '[DEBUG] Executing local command %r' % command
             logging.info('Executing local command %r' % command)
-            return self._execute_local(command)
+            return self._execute_local(command, callback=callback, stdin=stdin, **limit)
 
-    def execute_apt(self, command, params=list(), options=list()):
-        """ führt einen bestimmten apt-befehl aus, wahlweise per ssh oder lokal """
-        # diese kommandos brauchen dringend parameter.
+    def _remote_command(self, command):
+        if self.sudo:
+            return 'sudo %s' % command
+        return command
+
+    def _parallel(self, *calls):
+        """ ruft mehrere funktionen gleichzeitig auf, per ssh läuft jeder befehl über einen eigenen kanal
+            derselben verbindung. liefert pro aufruf das ergebnis oder die aufgetretene exception """
+        results = [None] * len(calls)
+
+        def run_one(index, call):
+            try:
+                results[index] = call()
+            except Exception, ex:
+                results[index] = ex
+
+        threads = [threading.Thread(target=run_one, args=item) for item in enumerate(calls)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _apt_command_line(self, command, params=list(), options=list()):
         my_options = list(options)
         if self.simulate:
             my_options.append('-s')
-
-        shell_command = '%s %s %s %s' % (
+        return '%s %s %s %s' % (
             self.apt_executable,
             ' '.join(my_options),
             command,
             ' '.join(params)
         )
-        output = self._execute(shell_command)
+
+    def execute_apt(self, command, params=list(), options=list(), callback=None):
+        """ führt einen bestimmten apt-befehl aus, wahlweise per ssh oder lokal """
+        output = self._execute(self._apt_command_line(command, params, options), callback)
         return output
 
-    def get_all_packages(self):
-        """ listet alle pakete von einem rechner auf"""
-        command = "/usr/bin/dpkg --get-selections | /usr/bin/awk '{print $1, $2};'"
-        logging.debug('Executing command %s' % command)
-        packages = self._execute(command)
-        self.package_list = [i.split(' ') for i in packages.split('\n')]
-        # remove empty last entry line
-        self.package_list.pop()
+    def _parse_packages(self, packages):
+        # skip empty lines instead of blindly dropping the last entry
+        return [line.split(' ') for line in packages.split('\n') if line]
+
+    def get_fingerprint(self):
+        """ günstiger fingerabdruck der dpkg-datenbank, ändert sich mit jeder paketänderung """
+        return ' '.join(self._execute(self.FINGERPRINT_COMMAND).split())
+
+    def _facts_command(self, marker, known_fingerprint=None, selections=True):
+        sections = [
+            ('distribution', '/usr/bin/lsb_release -ds 2>/dev/null'),
+            ('architecture', '/usr/bin/dpkg --print-architecture'),
+            ('time', '/bin/date +%s'),
+            ('lists', self.LISTS_COMMAND),
+            ('fingerprint', 'echo "$fingerprint"'),
+            ('dpkg_log', '/usr/bin/stat -c %%s %s 2>/dev/null || echo 0' % self.DPKG_LOG),
+        ]
+        script = ['fingerprint=$(%s)' % self.FINGERPRINT_COMMAND]
+        for name, command in sections:
+            script.append("echo '%s%s'; %s" % (marker, name, command))
+        # the selections are only sent if the cached snapshot is outdated
+        if selections:
+            script.append('if [ "$fingerprint" != %s ]; then echo \'%sselections\'; %s; fi' % (
+                pipes.quote(known_fingerprint or ''), marker, self.SELECTIONS_COMMAND))
+        return '/bin/sh -c %s' % pipes.quote('; '.join(script))
+
+    def gather_facts(self, cache=None, selections=True):
+        """ holt distribution, architektur, dpkg-fingerabdruck, aktualität der apt-listen und
+            (falls nötig) die paketliste in einem einzigen befehl mit eindeutig markierten abschnitten.
+            mit selections=False nur die fakten, die paketliste bleibt wie sie ist """
+        marker = '@@yarapt-%s@@ ' % os.urandom(6).encode('hex')
+        known_fingerprint = cache and cache.peek(self.host)
+        output = self._execute(self._facts_command(marker, known_fingerprint, selections))
+        sections = {}
+        current = None
+        for line in output.split('\n'):
+            if line.startswith(marker):
+                current = sections.setdefault(line[len(marker):], list())
+            elif current is not None:
+                current.append(line)
+        facts = dict((name, '\n'.join(lines).strip()) for name, lines in sections.items() if name != 'selections')
+        lists = facts.get('lists', '').split()
+        facts['lists_mtime'] = int(lists[0]) if len(lists) == 3 else 0
+        facts['lists_hash'] = lists[-2] if len(lists) >= 2 else ''
+        facts['time'] = int(facts.get('time') or 0)
+        facts['dpkg_log'] = int(facts.get('dpkg_log') or 0)
+        fingerprint = facts.get('fingerprint')
+        if 'selections' in sections:
+            self.package_list = [line.split(' ') for line in sections['selections'] if line]
+            if cache:
+                cache.count(False)
+                cache.store(self.host, fingerprint, self.package_list)
+        elif selections:
+            self.package_list = cache and cache.load(self.host, fingerprint)
+            if self.package_list is None:
+                # snapshot vanished in between, fetch the list after all
+                self.package_list = self._parse_packages(self._execute(self.SELECTIONS_COMMAND))
+                if cache:
+                    cache.store(self.host, fingerprint, self.package_list)
+        self.facts = facts
+        return facts
+
+    @property
+    def distribution(self):
+        """ wird erst beim ersten zugriff ermittelt """
+        if self.facts is None:
+            self.gather_facts()
+        return self.facts.get('distribution', '')
+
+    @property
+    def architecture(self):
+        if self.facts is None:
+            self.gather_facts()
+        return self.facts.get('architecture', '')
+
+    def get_all_packages(self, cache=None):
+        """ listet alle pakete von einem rechner auf, mit cache nur wenn sich die dpkg-datenbank geändert hat """
+        self.gather_facts(cache)
         return self.package_list
 
-    def _list_to_set_with_filter(self, package_list, package_filter, negate=False):
-        tmp = list()
-        for package in package_list:
-            if len(package) == 2:
-                if negate and package[1] != package_filter:
-                    tmp.append(package[0])
-                if not negate and package[1] == package_filter:
-                    tmp.append(package[0])
+    def lists_stale(self, reference_facts=None, max_age=None):
+        """ sind die apt-listen veraltet? aktuell sind sie, wenn ihre Release-dateien denen des
+            referenzservers gleichen oder wenn sie jünger als max_age sekunden sind """
+        if self.facts is None:
+            self.gather_facts()
+        lists_hash = self.facts.get('lists_hash')
+        if not self.facts.get('lists_mtime'):
+            # no Release files at all
+            return True
+        if reference_facts and lists_hash == reference_facts.get('lists_hash'):
+            return False
+        if max_age is not None and self.facts['time'] - self.facts['lists_mtime'] < max_age:
+            return False
+        return True
+
+    def update_if_stale(self, reference_facts=None, max_age=None, callback=None):
+        """ apt-get update nur bei veralteten listen, liefert None wenn nichts zu tun war """
+        if not self.lists_stale(reference_facts, max_age):
+            logging.info('Apt lists of host %s are fresh, skipping update' % self.host)
+            return None
+        return self.execute_apt('update', callback=callback)
+
+    def _phase(self, name):
+        """ misst einen abschnitt, falls ein tracer gesetzt ist """
+        if self.tracer:
+            return self.tracer.phase(self.host, name)
+        return _untraced()
+
+    def prepare(self, update=False, cache=None, reference_facts=None, max_age=None):
+        """ holt paketliste und fakten; falls gewünscht danach apt-get update, wenn die listen veraltet sind.
+            ohne referenz und max_age läuft apt-get update immer, dann gleichzeitig mit den fakten.
+            liefert die ausgabe von apt-get update bzw. die exception, None wenn nichts zu tun war """
+        def facts():
+            with self._phase('facts'):
+                return self.gather_facts(cache)
+
+        def apt_update():
+            with self._phase('update'):
+                return self.execute_apt('update')
+
+        if update and reference_facts is None and max_age is None:
+            results = self._parallel(facts, apt_update)
+            if isinstance(results[0], Exception):
+                raise results[0]
+            return results[1]
+        facts()
+        if not update:
+            return None
+        try:
+            with self._phase('update'):
+                return self.update_if_stale(reference_facts, max_age)
+        except Exception, ex:
+            return ex
+
+    def get_package_index(self):
+        """ paketliste als {name: zustand}, wird nur einmal pro paketliste gebaut """
+        if self._package_index is None or self._indexed_list is not self.package_list:
+            self._package_index = syncplan.build_index(self.package_list)
+            self._indexed_list = self.package_list
+        return self._package_index
+
+    def package_states(self, names):
+        """ {name: zustand} nur für die angegebenen pakete, pakete die dpkg nicht kennt fehlen """
+        states = dict()
+        prefix = "/usr/bin/dpkg-query -W -f '${binary:Package} ${db:Status-Want}\\n' --"
+        for chunk in chunk_arguments([pipes.quote(name) for name in names], self.MAX_COMMAND_LENGTH - len(prefix)):
+            # dpkg-query fails for unknown packages but still lists the others
+            output = self._execute('/bin/sh -c %s' % pipes.quote('%s %s 2>/dev/null; true' % (prefix, ' '.join(chunk))))
+            for package in self._parse_packages(output):
+                if len(package) == 2:
+                    states[package[0]] = package[1]
+        return states
+
+    def verify_sync(self, names, cache=None):
+        """ prüft nach einem sync mit einem einzigen befehl die zustände der pakete aus names und aller,
+            die dpkg.log seit dem holen der fakten nennt (abhängigkeiten, autoremove). paketliste und index
+            werden damit ausgebessert; war das log lückenlos, passt die liste zum neuen fingerabdruck und
+            ersetzt den snapshot. liefert die zahl der geprüften pakete """
+        log = pipes.quote(self.DPKG_LOG)
+        offset = (self.facts or dict()).get('dpkg_log')
+        # dpkg.log names packages as name:arch, the selections leave out the native architecture and all
+        parse_log = ("/usr/bin/awk -v arch=%s '{ p = \"\" } $3 ~ /^(install|upgrade|remove|purge)$/ { p = $4 } "
+                     "$3 == \"status\" && NF >= 5 { p = $5 } p != \"\" { sub(\":(\" arch \"|all)$\", \"\", p); print p }'") % pipes.quote(self.architecture)
+        # the log is read from where it was when the facts were gathered
+        read_log = 'true'
+        if offset is not None:
+            read_log = 'if [ "$size" -ge %d ]; then /usr/bin/tail -c +%d %s | %s; fi' % (offset, offset + 1, log, parse_log)
+        script = [
+            'echo $(%s)' % self.FINGERPRINT_COMMAND,
+            'size=$(/usr/bin/stat -c %%s %s 2>/dev/null || echo 0)' % log,
+            'echo $size',
+            # the names come on stdin
+            'names=$({ /bin/cat; %s; } | /usr/bin/sort -u)' % read_log,
+            'echo $names',
+            "echo \"$names\" | /usr/bin/xargs -r /usr/bin/dpkg-query -W -f '${binary:Package} ${db:Status-Want}\\n' -- 2>/dev/null",
+            'true',
+        ]
+        output = self._execute('/bin/sh -c %s' % pipes.quote('; '.join(script)), stdin=''.join(['%s\n' % name for name in names]))
+        lines = output.split('\n')
+        while len(lines) < 3:
+            lines.append('')
+        fingerprint, size, queried = ' '.join(lines[0].split()), int(lines[1] or 0), lines[2].split()
+        states = dict(package for package in self._parse_packages('\n'.join(lines[3:])) if len(package) == 2)
+        complete = offset is not None and size >= offset
+
+        # packages dpkg doesn't know anymore are gone from the selections, like purged ones
+        changed = dict()
+        for name in queried:
+            qualified = '%s:%s' % (name, self.architecture)
+            if name not in states and qualified not in states:
+                changed[name] = changed[qualified] = None
+        for name, state in states.items():
+            changed[name] = state if state != 'unknown' else None
+        index = self.get_package_index()
+        for name, state in changed.items():
+            if state is None:
+                if name in index:
+                    del index[name]
             else:
-                logging.info('Error with package %s' % package)
-        return set(tmp)
+                index[name] = syncplan.STATES.get(state, syncplan.UNKNOWN)
+        package_list = [package for package in self.package_list if package[0] not in changed]
+        package_list.extend([[name, state] for name, state in changed.items() if state is not None])
+        package_list.sort()
+        self.package_list = self._indexed_list = package_list
+        if self.facts is not None:
+            self.facts['fingerprint'] = fingerprint
+            self.facts['dpkg_log'] = size
+        if cache and complete:
+            cache.store(self.host, fingerprint, package_list)
+        return len(queried)
+
+    def group_key(self):
+        """ rechner mit gleichem schlüssel bekommen denselben SyncPlan und dieselbe apt-simulation """
+        if self._digested_list is not self.package_list:
+            self._digest = syncplan.selections_digest(self.package_list)
+            self._digested_list = self.package_list
+        facts = self.facts or dict()
+        return (self._digest, facts.get('lists_hash'), facts.get('architecture'), facts.get('distribution'))
+
+    def sync_plan(self, master_index):
+        """ alle änderungen gegenüber dem masterserver in einem durchlauf """
+        return syncplan.SyncPlan(master_index, self.get_package_index())
 
     def get_missing_packages(self, master_package_list):
-        own_pkg = self._list_to_set_with_filter(self.package_list, 'install')
-        ref_pkg = self._list_to_set_with_filter(master_package_list, 'install')
-        missing = ref_pkg.difference(own_pkg)
-        return list(missing)
+        return self.sync_plan(syncplan.build_index(master_package_list)).missing
 
     def get_redundant_packages(self, master_package_list):
-        own_inst_pkg = self._list_to_set_with_filter(self.package_list, 'install')
-        own_pkg = self._list_to_set_with_filter(self.package_list, 'deinstall')
-        ref_pkg = self._list_to_set_with_filter(master_package_list, 'deinstall')
-        missing = ref_pkg.difference(own_pkg).intersection(own_inst_pkg)
-        return list(missing)
+        return self.sync_plan(syncplan.build_index(master_package_list)).redundant
 
     def get_purged_packages(self, master_package_list):
-        own_inst_pkg = self._list_to_set_with_filter(self.package_list, 'install')
-        own_pkg = self._list_to_set_with_filter(self.package_list, 'purge')
-        ref_pkg = self._list_to_set_with_filter(master_package_list, 'purge')
-        purged = ref_pkg.difference(own_pkg).intersection(own_inst_pkg)
-        return list(purged)
+        return self.sync_plan(syncplan.build_index(master_package_list)).purged
 
     def get_hold_packages(self, master_package_list):
-        own_hold_pkg = self._list_to_set_with_filter(self.package_list, 'hold')
-        #own_not_hold_pkg = self._list_to_set_with_filter(self.package_list, 'hold', negate=True)
-        ref_pkg = self._list_to_set_with_filter(master_package_list, 'hold')
-        hold = ref_pkg.difference(own_hold_pkg)
-        return list(hold)
+        return self.sync_plan(syncplan.build_index(master_package_list)).held
 
-    def install(self, package_list):
+    def install(self, package_list, options=list()):
         """ installiert alle pakete aus package_list """
-        output = self.execute_apt("install", package_list)
+        output = self.execute_apt("install", package_list, options)
         logging.debug(repr(output))
         return output
 
@@ -201,8 +457,142 @@ class AptMachine():
         output = self._execute(command)
         return output
 
+    def set_selections(self, selections):
+        """ setzt paketzustände in einem rutsch, selections ist eine liste von (name, zustand) """
+        if self.simulate:
+            return 'Simulated dpkg --set-selections for %d packages' % len(selections)
+        data = ''.join(['%s %s\n' % selection for selection in selections])
+        return self._execute('/usr/bin/dpkg --set-selections', stdin=data)
+
+    def apply_plan(self, plan, options=list(), callback=None):
+        """ wendet einen SyncPlan mit möglichst wenigen apt-läufen an: installieren und entfernen in
+            einem aufruf (pkg, pkg-), holds per dpkg --set-selections. apt-get kennt kein pkg_, purges
+            laufen daher nur mit im selben aufruf (--purge), wenn nichts nur entfernt werden soll;
+            aptitude versteht pkg_ direkt. zu lange paketlisten werden unterhalb von ARG_MAX aufgeteilt. """
+        output = list()
+        my_options = list(options)
+        changes = list(plan.missing)
+        changes.extend(['%s-' % name for name in plan.redundant])
+        purged = list(plan.purged)
+        if os.path.basename(self.apt_executable) == 'aptitude':
+            changes.extend(['%s_' % name for name in purged])
+            purged = list()
+        elif not plan.redundant and purged:
+            changes.extend(['%s-' % name for name in purged])
+            my_options.append('--purge')
+            purged = list()
+        steps = list()
+        for chunk in chunk_arguments(changes, self.MAX_COMMAND_LENGTH):
+            steps.append((self._apt_command_line('install', chunk, my_options), None))
+        for chunk in chunk_arguments(purged, self.MAX_COMMAND_LENGTH):
+            steps.append((self._apt_command_line('purge', chunk, options), None))
+        if plan.held and not self.simulate:
+            steps.append(('/usr/bin/dpkg --set-selections', ''.join(['%s hold\n' % name for name in plan.held])))
+        if self.helper and self.helper.channel and not callback:
+            # the whole plan in one request
+            output.extend(self._apply_helper(steps))
+        else:
+            for command, stdin in steps:
+                output.append(self._execute(command, callback, stdin))
+        if plan.held and self.simulate:
+            output.append(self.set_selections([(name, 'hold') for name in plan.held]))
+        return '\n'.join([line for line in output if line])
+
+    def _apply_helper(self, steps, timeout=15):
+        """ mehrere befehle hintereinander über den entfernten helfer, bricht beim ersten fehler ab """
+        commands = [(self._remote_command(command.strip()), stdin) for command, stdin in steps]
+        logging.info('Executing %d commands via the remote helper on host %s' % (len(commands), self.host))
+        start_time = time.time()
+        try:
+            results = self.helper.request('apply', timeout * len(commands), commands=commands)['results']
+        except socket.timeout:
+            raise TimeoutException('Commands %r on host %s timed out after %d seconds.' % (commands, self.host, timeout * len(commands)))
+        except remote.HelperError, ex:
+            raise ShellException('Remote helper on host %s failed: %s' % (self.host, ex))
+        output = list()
+        for (command, stdin), result in zip(commands, results):
+            self._trace(command, start_time, result['stdout'], result['stderr'], result['returncode'])
+            start_time = time.time()
+            # negative codes are signals, the command didn't finish either
+            if result['returncode'] != 0:
+                raise ShellException('Command "%s" on host %s returned %d, messages:\n%s' % (command, self.host, result['returncode'], result['stderr'].strip()))
+            if result['stderr'].strip():
+                logging.warn('Got error output for command %r on host %s:\n %s' % (command, self.host, result['stderr'].strip()))
+            output.append(result['stdout'].strip())
+        if len(results) < len(commands):
+            raise ShellException('Remote helper on host %s stopped after %d of %d commands' % (self.host, len(results), len(commands)))
+        return output
+
+    def get_selections(self, since=None):
+        """ (fingerprint, paketliste) in einem aufruf, die liste ist None, wenn der fingerabdruck noch since ist """
+        if self.helper and self.helper.channel:
+            try:
+                result = self.helper.request('selections', 15, since=since)
+            except (socket.timeout, remote.HelperError), ex:
+                raise ShellException('Remote helper on host %s failed to list the selections: %s' % (self.host, ex))
+            if result['selections'] is None:
+                return result['fingerprint'], None
+            return result['fingerprint'], self._parse_packages(result['selections'])
+        script = 'fingerprint=$(%s); echo "$fingerprint"; if [ "$fingerprint" != %s ]; then %s; fi' % (
+            self.FINGERPRINT_COMMAND, pipes.quote(since or ''), self.SELECTIONS_COMMAND)
+        output = self._execute('/bin/sh -c %s' % pipes.quote(script))
+        fingerprint, _, packages = output.partition('\n')
+        fingerprint = ' '.join(fingerprint.split())
+        if fingerprint == since:
+            return fingerprint, None
+        return fingerprint, self._parse_packages(packages)
+
+    def archive_options(self):
+        """ apt-optionen, damit apt die archive aus archive_dir nimmt, falls das nicht der apt-cache ist """
+        if self.archive_dir == self.APT_ARCHIVES:
+            return list()
+        return ['-o', 'Dir::Cache::Archives=%s/' % self.archive_dir]
+
+    def archive_sizes(self, directory):
+        """ {dateiname: größe} aller .deb-archive in directory, legt das verzeichnis bei bedarf an """
+        directory = pipes.quote(directory)
+        # one shell, so that sudo covers every part of it
+        output = self._execute('/bin/sh -c %s' % pipes.quote("/bin/mkdir -p %s/partial && /usr/bin/find %s -maxdepth 1 -name '*.deb' -printf '%%s %%f\\n'" % (directory, directory)))
+        sizes = dict()
+        for line in output.split('\n'):
+            if line:
+                size, filename = line.split(' ', 1)
+                sizes[filename] = int(size)
+        return sizes
+
+    def archive_hashes(self, directory, filenames):
+        """ {dateiname: sha256} der angegebenen dateien in directory """
+        hashes = dict()
+        # cd is a shell builtin, sudo can only run it inside a shell
+        prefix = 'cd %s && /usr/bin/sha256sum --' % pipes.quote(directory)
+        for chunk in chunk_arguments([pipes.quote(filename) for filename in filenames], (self.MAX_COMMAND_LENGTH - len(prefix)) / 2):
+            for line in self._execute('/bin/sh -c %s' % pipes.quote('%s %s' % (prefix, ' '.join(chunk)))).split('\n'):
+                if line:
+                    digest, filename = line.split(None, 1)
+                    hashes[filename.lstrip('*')] = digest
+        return hashes
+
+    def fetch_files(self, files, parallel=4):
+        """ kopiert (entfernt, lokal)-paare vom rechner, per sftp mehrere gleichzeitig """
+        if self.connection:
+            self.connection.get_many(files, parallel)
+        else:
+            for source, destination in files:
+                shutil.copyfile(source, destination)
+
+    def push_files(self, files, parallel=4):
+        """ kopiert (lokal, entfernt)-paare auf den rechner, per sftp mehrere gleichzeitig """
+        if self.connection:
+            self.connection.put_many(files, parallel)
+        else:
+            for source, destination in files:
+                shutil.copyfile(source, destination)
+
     def close(self):
         """ schließt ggfs. die ssh verbindung zum entfernten rechner """
+        if self.helper:
+            self.helper.close()
+            self.helper = None
         if self.connection:
             self.connection.close()
 
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" .deb archives downloaded once on the reference host and pushed to the targets """
+
+import os
+import pipes
+import hashlib
+import logging
+import threading
+from helpers import chunk_arguments
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as archive:
+        for block in iter(lambda: archive.read(65536), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class ArchiveDepot(object):
+    """ apt-get -d fetches the archives on the reference host into a directory of its own.
+        it is outside of the apt cache, so clean and autoclean can't remove anything before
+        the targets got it. the archives are copied to the controller once and pushed from
+        there to every target that needs them, files a target already has with the same
+        size and hash are skipped. """
+    REMOTE_DIRECTORY = '/var/cache/yarapt/archives'
+
+    def __init__(self, reference, directory='./var/cache/yarapt/archives', parallel=4):
+        self.reference = reference
+        self.directory = directory
+        self.parallel = parallel
+        # package name: (filename, size, sha256) of everything staged in this run
+        self.archives = dict()
+        # filename: (size, sha256), only new or changed files are hashed again
+        self._known = dict()
+        self.requested = set()
+        self.pushed = 0
+        self.present = 0
+        self.pushed_bytes = 0
+        self._cleared = False
+        # apt-get -d locks the archive directory on the reference, staging runs one at a time.
+        # the bookkeeping lock is never held during remote work, distribution goes on meanwhile
+        self._stage_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def stage(self, command, packages=list(), options=list()):
+        """ runs apt-get -d command on the reference and copies the new archives to the controller.
+            packages which were already requested in this run are not downloaded again """
+        with self._stage_lock:
+            wanted = [name for name in packages if name not in self.requested]
+            if packages and not wanted:
+                return
+            self.requested.update(wanted)
+            remote = self.REMOTE_DIRECTORY
+            if not self._cleared:
+                # only this run's archives are distributed, the controller keeps older ones
+                self.reference._execute('/bin/sh -c %s' % pipes.quote('/bin/mkdir -p %s/partial && /bin/rm -f %s/*.deb' % (remote, remote)))
+                self._cleared = True
+            my_options = list(options) + ['-d', '-y', '-o', 'Dir::Cache::Archives=%s/' % remote]
+            if command == 'install':
+                # the reference has these packages already, without --reinstall nothing is downloaded
+                my_options.append('--reinstall')
+            if wanted:
+                for chunk in chunk_arguments(wanted, self.reference.MAX_COMMAND_LENGTH):
+                    self.reference.execute_apt(command, chunk, my_options)
+            else:
+                self.reference.execute_apt(command, options=my_options)
+            self._fetch()
+
+    def _fetch(self):
+        """ copies all archives staged on the reference which the controller doesn't have yet """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        remote = self.REMOTE_DIRECTORY
+        sizes = self.reference.archive_sizes(remote)
+        new = [filename for filename, size in sizes.items() if self._known.get(filename, (None,))[0] != size]
+        hashes = self.reference.archive_hashes(remote, new) if new else dict()
+        transfers = list()
+        staged = dict()
+        for filename in new:
+            size, digest = sizes[filename], hashes.get(filename)
+            path = os.path.join(self.directory, filename)
+            if not (os.path.isfile(path) and os.path.getsize(path) == size and file_sha256(path) == digest):
+                transfers.append(('%s/%s' % (remote, filename), path))
+            staged[filename.split('_', 1)[0]] = (filename, size, digest)
+        self.reference.fetch_files(transfers, self.parallel)
+        with self._lock:
+            for name, (filename, size, digest) in staged.items():
+                self._known[filename] = (size, digest)
+                self.archives[name] = (filename, size, digest)
+        logging.info('Staged %d new archives, fetched %d from %s' % (len(new), len(transfers), self.reference.host))
+
+    def distribute(self, apt_cmd, packages=None):
+        """ pushes the archives of packages (all staged ones if None) into the archive_dir of a target,
+            returns a line for the host report """
+        with self._lock:
+            if packages is None:
+                archives = self.archives.values()
+            else:
+                archives = [self.archives[name] for name in packages if name in self.archives]
+        if not archives:
+            return 'Archives: nothing staged'
+        directory = apt_cmd.archive_dir
+        sizes = apt_cmd.archive_sizes(directory)
+        candidates = [filename for filename, size, digest in archives if sizes.get(filename) == size]
+        hashes = apt_cmd.archive_hashes(directory, candidates) if candidates else dict()
+        transfers = list()
+        pushed_bytes = 0
+        for filename, size, digest in archives:
+            if hashes.get(filename) != digest:
+                transfers.append((os.path.join(self.directory, filename), '%s/%s' % (directory, filename)))
+                pushed_bytes += size
+        apt_cmd.push_files(transfers, self.parallel)
+        with self._lock:
+            self.pushed += len(transfers)
+            self.present += len(archives) - len(transfers)
+            self.pushed_bytes += pushed_bytes
+        return 'Archives: %d pushed (%.1f MB), %d already present' % (
+            len(transfers), pushed_bytes / 1048576.0, len(archives) - len(transfers))
+
+    def summary(self):
+        return 'Archives: %d staged, %d pushed (%.1f MB), %d already present' % (
+            len(self.archives), self.pushed, self.pushed_bytes / 1048576.0, self.present)
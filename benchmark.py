@@ -0,0 +1,408 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" benchmark harness: synthetic package lists, simulated hosts and timings written as JSON
+
+    Hosts are simulated in two ways, both backed by a directory with a synthetic
+    dpkg selections file and shell shims for dpkg, lsb_release, apt-get and aptitude:
+      - ShimMachine, an AptMachine which rewrites its commands to the shims locally
+      - FakeSSHServer, a paramiko ServerInterface listening on 127.0.0.x, one address per host
+    Both add a tunable latency to every command.
+"""
+
+import os
+import re
+import sys
+import time
+import shlex
+import shutil
+import random
+import socket
+import select
+import tempfile
+import platform
+import threading
+import subprocess
+try:
+    import argparse
+except ImportError:
+    print "Package python-argparse is missing. Please install it."
+    sys.exit(1)
+try:
+    import simplejson as json
+except ImportError:
+    print "Package python-simplejson is missing. Please install it."
+    sys.exit(1)
+import paramiko
+import ssh
+import local
+import syncplan
+from aptmachine import AptMachine
+from cache import SnapshotCache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATES = ['install'] * 90 + ['deinstall'] * 6 + ['purge'] * 2 + ['hold'] * 2
+# summary line of yarapt, the number of failed hosts
+SUMMARY = re.compile(r'^Hosts: \d+, ok: \d+, failed: (\d+)', re.M)
+
+DPKG_SHIM = r'''#!/bin/sh
+root=$(cd "$(dirname "$0")/.." && pwd)
+case "$1" in
+    --get-selections) exec cat "$root/selections" ;;
+    --print-architecture) echo amd64 ;;
+    --set-selections)
+        awk 'FILENAME == "-" { state[$1] = $2; next }
+             ($1 in state) { $2 = state[$1]; delete state[$1] }
+             { print $1, $2 }
+             END { for (name in state) print name, state[name] }' - "$root/selections" > "$root/selections.tmp" &&
+        mv "$root/selections.tmp" "$root/selections" ;;
+esac
+'''
+
+DPKG_QUERY_SHIM = r'''#!/bin/sh
+# dpkg-query -W [-f format] -- name..., always answers "name state" like the format AptMachine uses
+root=$(cd "$(dirname "$0")/.." && pwd)
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -f) shift ;;
+        --) shift; break ;;
+        -*) ;;
+        *) break ;;
+    esac
+    shift
+done
+printf '%s\n' "$@" | awk 'FILENAME == "-" { wanted[$1] = 1; next }
+    { name = $1; sub(/:amd64$/, "", name) }
+    ($1 in wanted) || (name in wanted) { print $1, $2 }' - "$root/selections"
+'''
+
+LSB_RELEASE_SHIM = '''#!/bin/sh
+echo "Debian GNU/Linux 12 (bookworm)"
+'''
+
+APT_GET_SHIM = r'''#!/bin/sh
+root=$(cd "$(dirname "$0")/.." && pwd)
+sleep %(apt_delay)s
+command=''
+packages=''
+simulate=''
+purge=''
+for arg in "$@"; do
+    case "$arg" in
+        -s) simulate=1 ;;
+        --purge) purge=purge ;;
+        -*) ;;
+        *) if [ -z "$command" ]; then command=$arg; else packages="$packages $arg"; fi ;;
+    esac
+done
+echo "Reading package lists..."
+[ -n "$simulate" ] && exit 0
+case "$command" in
+    install|remove|purge)
+        for package in $packages; do
+            case "$command:$package" in
+                install:*-) echo "${package%%-} ${purge:-deinstall}" ;;
+                install:*) echo "$package install" ;;
+                remove:*) echo "$package ${purge:-deinstall}" ;;
+                purge:*) echo "$package purge" ;;
+            esac
+        done | "$root/bin/dpkg" --set-selections ;;
+    update) touch "$root/lists/"*Release ;;
+esac
+'''
+
+APTITUDE_SHIM = r'''#!/bin/sh
+root=$(cd "$(dirname "$0")/.." && pwd)
+shift
+for package in "$@"; do echo "$package hold"; done | "$root/bin/dpkg" --set-selections
+'''
+
+def generate_selections(count, seed=0):
+    """ synthetic `dpkg --get-selections` list with count packages """
+    rng = random.Random(seed)
+    return [['pkg-%06d:amd64' % i if i % 7 == 0 else 'pkg-%06d' % i, rng.choice(STATES)] for i in range(count)]
+
+def drift(package_list, rate, seed=0):
+    """ copy of package_list with a fraction rate of the entries changed, dropped or added """
+    rng = random.Random(seed)
+    drifted = list()
+    for name, state in package_list:
+        roll = rng.random()
+        if roll >= rate:
+            drifted.append([name, state])
+        elif roll < rate * 0.7:
+            drifted.append([name, rng.choice(STATES)])
+        elif roll < rate * 0.85:
+            drifted.append(['extra-%s' % name, 'install'])
+    return drifted
+
+class FakeHost(object):
+    """ directory with a selections file, apt lists and shims standing in for a host """
+
+    def __init__(self, directory, name, package_list, apt_delay=0.0, release='1'):
+        self.name = name
+        self.root = os.path.join(directory, name)
+        os.makedirs(os.path.join(self.root, 'bin'))
+        os.makedirs(os.path.join(self.root, 'lists'))
+        with open(os.path.join(self.root, 'selections'), 'w') as selections:
+            selections.write(''.join(['%s %s\n' % tuple(package) for package in package_list]))
+        with open(os.path.join(self.root, 'lists', 'bench_InRelease'), 'w') as lists:
+            lists.write('Release %s\n' % release)
+        for tool, script in (('dpkg', DPKG_SHIM), ('dpkg-query', DPKG_QUERY_SHIM), ('lsb_release', LSB_RELEASE_SHIM),
+                             ('apt-get', APT_GET_SHIM % {'apt_delay': apt_delay}), ('aptitude', APTITUDE_SHIM)):
+            path = os.path.join(self.root, 'bin', tool)
+            with open(path, 'w') as shim:
+                shim.write(script)
+            os.chmod(path, 0755)
+
+    def rewrite(self, command):
+        """ points the tools and files used by AptMachine to the shims of this host """
+        # dpkg-query before dpkg, which is a prefix of it. the shims write no dpkg.log
+        for real, shim in (('/usr/bin/dpkg-query', 'bin/dpkg-query'), ('/usr/bin/dpkg', 'bin/dpkg'),
+                           ('/usr/bin/lsb_release', 'bin/lsb_release'), ('/usr/bin/apt-get', 'bin/apt-get'),
+                           ('/var/lib/dpkg/status', 'selections'), ('/var/lib/apt/lists', 'lists'),
+                           ('/var/log/dpkg.log', 'dpkg.log')):
+            command = command.replace(real, os.path.join(self.root, shim))
+        if command.startswith('aptitude '):
+            command = os.path.join(self.root, 'bin', command)
+        return command
+
+class ShimMachine(AptMachine):
+    """ AptMachine running against a FakeHost, every command pays latency seconds """
+
+    def __init__(self, fake_host, latency=0.0, **kwargs):
+        self.fake_host = fake_host
+        self.latency = latency
+        kwargs.setdefault('host', fake_host.name)
+        AptMachine.__init__(self, **kwargs)
+
+    def _execute(self, command, callback=None, stdin=None, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        return AptMachine._execute(self, self.fake_host.rewrite(command), callback, stdin, timeout)
+
+class _FakeServerInterface(paramiko.ServerInterface):
+    """ accepts every login and runs exec requests against the FakeHost of the address """
+
+    def __init__(self, fake_host, latency):
+        self.fake_host = fake_host
+        self.latency = latency
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._run, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _run(self, channel, command):
+        stdin = list()
+        while True:
+            data = channel.recv(32768)
+            if not data:
+                break
+            stdin.append(data)
+        if self.latency:
+            time.sleep(self.latency)
+        output, stderr, returncode = local.execute(self.fake_host.rewrite(command), None, stdin=''.join(stdin) or None)
+        channel.sendall(output)
+        channel.sendall_stderr(stderr)
+        channel.send_exit_status(returncode)
+        channel.shutdown_write()
+        channel.close()
+
+class FakeSSHServer(object):
+    """ one listening socket per FakeHost on 127.0.0.2, 127.0.0.3, ... with a shared port """
+
+    def __init__(self, fake_hosts, latency=0.0, port=0):
+        self.key = paramiko.RSAKey.generate(1024)
+        self.latency = latency
+        self.sockets = dict()
+        self.addresses = dict()
+        self.transports = list()
+        for index, fake_host in enumerate(fake_hosts):
+            address = '127.0.%d.%d' % ((index + 2) // 256, (index + 2) % 256)
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((address, port))
+            port = listener.getsockname()[1]
+            listener.listen(16)
+            self.sockets[listener] = fake_host
+            self.addresses[fake_host.name] = address
+        self.port = port
+        self._running = True
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        while self._running:
+            readable = select.select(self.sockets.keys(), [], [], 0.2)[0]
+            for listener in readable:
+                client = listener.accept()[0]
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                transport = paramiko.Transport(client)
+                transport.add_server_key(self.key)
+                transport.start_server(server=_FakeServerInterface(self.sockets[listener], self.latency))
+                self.transports.append(transport)
+
+    def config(self):
+        """ config.json entries for all hosts """
+        return [{'host': address, 'port': self.port, 'username': 'bench', 'password': 'bench',
+                 'ssh': True, 'sudo': False} for address in sorted(self.addresses.values())]
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        for transport in self.transports:
+            transport.close()
+        for listener in self.sockets:
+            listener.close()
+
+def measure(repeat, function, *args):
+    """ best wall time of repeat calls """
+    best = None
+    for i in range(repeat):
+        start_time = time.time()
+        function(*args)
+        duration = time.time() - start_time
+        if best is None or duration < best:
+            best = duration
+    return best
+
+class Benchmark(object):
+    """ runs all measurements and collects them as JSON records """
+
+    def __init__(self, args):
+        self.args = args
+        self.results = list()
+        self.directory = tempfile.mkdtemp(prefix='yarapt-bench-')
+        os.makedirs(os.path.join(self.directory, 'var', 'log'))
+        self._cwd = os.getcwd()
+        os.chdir(self.directory)
+
+    def record(self, name, seconds, **params):
+        self.results.append({'name': name, 'seconds': round(seconds, 6), 'params': params})
+        print '%-28s %10.4fs  %s' % (name, seconds, ' '.join(['%s=%s' % item for item in sorted(params.items())]))
+
+    def bench_plan(self, size):
+        master_list = generate_selections(size)
+        host_list = drift(master_list, self.args.drift, seed=1)
+        master_index = syncplan.build_index(master_list)
+        host_index = syncplan.build_index(host_list)
+        self.record('build_index', measure(self.args.repeat, syncplan.build_index, host_list), packages=size)
+        self.record('sync_plan', measure(self.args.repeat, syncplan.SyncPlan, master_index, host_index),
+                    packages=size, drift=self.args.drift)
+        fake_host = FakeHost(self.directory, 'plan-%d' % size, host_list)
+        apt_cmd = ShimMachine(fake_host)
+        apt_cmd.get_all_packages()
+
+        def legacy_diff():
+            apt_cmd.get_missing_packages(master_list)
+            apt_cmd.get_redundant_packages(master_list)
+            apt_cmd.get_purged_packages(master_list)
+            apt_cmd.get_hold_packages(master_list)
+        self.record('get_x_packages', measure(self.args.repeat, legacy_diff), packages=size, drift=self.args.drift)
+
+    def bench_listing(self, size):
+        fake_host = FakeHost(self.directory, 'list-%d' % size, generate_selections(size))
+        apt_cmd = ShimMachine(fake_host, latency=self.args.latency)
+        self.record('get_all_packages', measure(self.args.repeat, apt_cmd.get_all_packages),
+                    packages=size, latency=self.args.latency)
+        cache = SnapshotCache(os.path.join(self.directory, 'var', 'cache', 'yarapt'))
+        apt_cmd.get_all_packages(cache)
+        self.record('get_all_packages_cached', measure(self.args.repeat, apt_cmd.get_all_packages, cache),
+                    packages=size, latency=self.args.latency)
+
+    def bench_ssh(self, sizes):
+        fake_hosts = [FakeHost(self.directory, 'ssh-%d' % size, generate_selections(size)) for size in sizes]
+        server = FakeSSHServer(fake_hosts, latency=self.args.latency)
+        try:
+            for fake_host, size in zip(fake_hosts, sizes):
+                connection = ssh.Connection(server.addresses[fake_host.name], username='bench', password='bench', port=server.port)
+                self.record('ssh_execute_echo', measure(self.args.repeat, connection.execute, 'echo'),
+                            latency=self.args.latency)
+                self.record('ssh_execute_selections', measure(self.args.repeat, connection.execute, AptMachine.SELECTIONS_COMMAND),
+                            packages=size, latency=self.args.latency)
+                connection.close()
+        finally:
+            server.close()
+            ssh.close_all()
+
+    def bench_sync(self, hosts, size):
+        master_list = generate_selections(size)
+        fake_hosts = [FakeHost(self.directory, 'sync-%d-%d' % (hosts, index),
+                               drift(master_list, self.args.drift, seed=index) if index else master_list,
+                               apt_delay=self.args.apt_delay, release=index % 2)
+                      for index in range(hosts + 1)]
+        server = FakeSSHServer(fake_hosts, latency=self.args.latency)
+        try:
+            config = server.config()
+            config[0]['reference'] = True
+            with open('config.json', 'w') as config_file:
+                json.dump(config, config_file)
+            command = [sys.executable, os.path.join(BASE_DIR, 'yarapt.py'), '-p', str(self.args.parallel), 'sync'] + shlex.split(self.args.sync_options)
+            start_time = time.time()
+            process = subprocess.Popen(command, stdout=subprocess.PIPE)
+            output = process.communicate()[0]
+            duration = time.time() - start_time
+            # the last summary is the one over all hosts
+            counts = SUMMARY.findall(output)
+            self.record('sync_task', duration, hosts=hosts, packages=size, drift=self.args.drift,
+                        parallel=self.args.parallel, latency=self.args.latency, returncode=process.returncode,
+                        failed=int(counts[-1]) if counts else None, options=self.args.sync_options)
+        finally:
+            server.close()
+
+    def run(self):
+        try:
+            for size in self.args.sizes:
+                self.bench_plan(size)
+                self.bench_listing(size)
+            self.bench_ssh(self.args.sizes)
+            for hosts in self.args.hosts:
+                self.bench_sync(hosts, self.args.sync_size)
+        finally:
+            os.chdir(self._cwd)
+            shutil.rmtree(self.directory, ignore_errors=True)
+        return {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'paramiko': paramiko.__version__,
+            'machine': platform.platform(),
+            'arguments': vars(self.args),
+            'results': self.results,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks yarapt against simulated hosts')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000, 50000], help='package list sizes (default: %(default)s)', metavar='N')
+    parser.add_argument('--hosts', type=int, nargs='+', default=[1, 10, 50], help='target host counts for the full sync (default: %(default)s)', metavar='N')
+    parser.add_argument('--sync-size', type=int, default=5000, help='packages per host for the full sync (default: %(default)s)', metavar='N')
+    parser.add_argument('--sync-options', default='-s', help='options given to yarapt sync, e.g. --sync-options="--batch" (default: %(default)s)', metavar='options')
+    parser.add_argument('--drift', type=float, default=0.02, help='fraction of packages differing from the reference (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every simulated command (default: %(default)s)')
+    parser.add_argument('--apt-delay', type=float, default=0.0, help='seconds every simulated apt-get call takes (default: %(default)s)')
+    parser.add_argument('-p', '--parallel', type=int, default=10, help='--parallel for the full sync (default: %(default)s)', metavar='N')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions, the best one counts (default: %(default)s)')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON result file (default: %(default)s)', metavar='file')
+    args = parser.parse_args()
+    results = Benchmark(args).run()
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print 'Results written to %s' % args.output
+
+if __name__ == "__main__":
+    main()
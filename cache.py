@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" local on-disk snapshots of every host's dpkg selections """
+
+import os
+import zlib
+import logging
+import threading
+
+class SnapshotCache(object):
+    """ keeps one zlib compressed package list per host, together with the fingerprint
+        of the dpkg database it was taken from. a snapshot is only used as long as
+        the host still reports the same fingerprint. the fingerprint is stored as an
+        uncompressed first line, so it can be looked up cheaply. """
+
+    def __init__(self, directory='./var/cache/yarapt'):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, host):
+        return os.path.join(self.directory, '%s.snapshot' % host.replace(os.sep, '_'))
+
+    def count(self, hit):
+        """ counts a lookup which was decided elsewhere, too """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def peek(self, host):
+        """ fingerprint of the snapshot of host, None if there is none """
+        try:
+            with open(self._path(host), 'rb') as snapshot:
+                return snapshot.readline().rstrip('\n') or None
+        except IOError:
+            return None
+
+    def load(self, host, fingerprint):
+        """ returns the cached package list of host, or None if there is none for fingerprint """
+        try:
+            with open(self._path(host), 'rb') as snapshot:
+                cached_fingerprint = snapshot.readline().rstrip('\n')
+                if cached_fingerprint != fingerprint:
+                    self.count(False)
+                    return None
+                packages = zlib.decompress(snapshot.read())
+        except (IOError, zlib.error):
+            self.count(False)
+            return None
+        self.count(True)
+        return [line.split(' ') for line in packages.split('\n') if line]
+
+    def store(self, host, fingerprint, package_list):
+        """ replaces the snapshot of host atomically """
+        data = '\n'.join([' '.join(package) for package in package_list])
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(host)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as snapshot:
+                snapshot.write('%s\n' % fingerprint)
+                snapshot.write(zlib.compress(data, 9))
+            os.rename(tmp_path, path)
+        except (IOError, OSError), ex:
+            logging.warn('Could not write snapshot of host %s: %s' % (host, ex))
+
+    def summary(self):
+        return 'Snapshot cache: %d hits, %d misses' % (self.hits, self.misses)
@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" warm controller: keeps authenticated connections and host facts between runs and serves
+    them on a unix socket. the protocol is one JSON object per line, the client sends one
+    request and gets one message per host and a final {"done": true}. """
+
+import os
+import time
+import socket
+import logging
+import threading
+import SocketServer
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from runner import Runner
+from helpers import colorize
+from helpers import GREEN
+
+SOCKET_PATH = './var/run/yarapt.sock'
+
+def format_facts(facts):
+    """ facts of a host as "name: value" lines, the same with and without the daemon """
+    return '\n'.join(['%s: %s' % (name, facts[name]) for name in sorted(facts) if name != 'gathered'])
+
+class ConnectionPool(object):
+    """ AptMachines kept open between requests, keyed by everything they were created with.
+        ssh connections send keepalives, unused ones are closed after idle seconds. """
+
+    def __init__(self, idle=600, keepalive=30):
+        self.idle = idle
+        self.keepalive = keepalive
+        # key: [apt_cmd, last used, users]
+        self._entries = dict()
+        self._keys = dict()
+        self._lock = threading.Lock()
+
+    def _alive(self, apt_cmd):
+        return apt_cmd.connection is None or apt_cmd.connection.is_active()
+
+    def acquire(self, **kwargs):
+        key = json.dumps(kwargs, sort_keys=True)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self._alive(entry[0]):
+                entry[1] = time.time()
+                entry[2] += 1
+                return entry[0]
+        # imported here, DaemonClient must stay cheap to import
+        from aptmachine import AptMachine
+        apt_cmd = AptMachine(**kwargs)
+        if apt_cmd.connection and self.keepalive:
+            apt_cmd.connection.set_keepalive(self.keepalive)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] is not apt_cmd and self._alive(entry[0]):
+                # another request connected at the same time, keep only one
+                entry[2] += 1
+                spare, apt_cmd = apt_cmd, entry[0]
+            else:
+                spare = entry and entry[0]
+                self._entries[key] = [apt_cmd, time.time(), 1]
+                self._keys[id(apt_cmd)] = key
+        if spare:
+            self._close(spare)
+        return apt_cmd
+
+    def release(self, apt_cmd):
+        with self._lock:
+            entry = self._entries.get(self._keys.get(id(apt_cmd)))
+            if entry and entry[0] is apt_cmd:
+                entry[1] = time.time()
+                entry[2] -= 1
+
+    def _close(self, apt_cmd):
+        with self._lock:
+            self._keys.pop(id(apt_cmd), None)
+        try:
+            apt_cmd.close()
+        except Exception:
+            pass
+
+    def evict(self):
+        """ closes connections which are unused for too long or broken, returns how many """
+        now = time.time()
+        with self._lock:
+            stale = [key for key, (apt_cmd, last_used, users) in self._entries.items()
+                     if users <= 0 and (now - last_used > self.idle or not self._alive(apt_cmd))]
+            machines = [self._entries.pop(key)[0] for key in stale]
+        for apt_cmd in machines:
+            logging.info('Closing idle connection to %s' % apt_cmd.host)
+            self._close(apt_cmd)
+        return len(machines)
+
+    def status(self):
+        """ one line per open connection """
+        now = time.time()
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda entry: entry[0].host)
+        return ['%-40s idle %6.0fs, users %d, %s' % (apt_cmd.host, now - last_used, users,
+                                                     (apt_cmd.facts or dict()).get('distribution', 'no facts yet'))
+                for apt_cmd, last_used, users in entries]
+
+    def close_all(self):
+        with self._lock:
+            machines = [entry[0] for entry in self._entries.values()]
+            self._entries.clear()
+        for apt_cmd in machines:
+            self._close(apt_cmd)
+
+class PooledRunner(Runner):
+    """ Runner whose connections come from the pool and stay open, reports go to send() """
+
+    def __init__(self, pool, send, parallel=1, color=False):
+        Runner.__init__(self, parallel, color)
+        self.pool = pool
+        self.send = send
+
+    def connect(self, **kwargs):
+        with self.tracer.phase(kwargs.get('host'), 'connect'):
+            return self.pool.acquire(**kwargs)
+
+    def release(self, apt_cmd):
+        self.pool.release(apt_cmd)
+
+    def close_all(self):
+        # the connections belong to the pool
+        pass
+
+    def show(self, report):
+        self.send(report.to_dict())
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        lock = threading.Lock()
+
+        def send(message):
+            with lock:
+                self.wfile.write(json.dumps(message) + '\n')
+                self.wfile.flush()
+
+        try:
+            self.server.yarapt.dispatch(json.loads(self.rfile.readline()), send)
+        except Exception, ex:
+            logging.exception('Request failed')
+            send({'error': str(ex)})
+        send({'done': True})
+
+class Daemon(object):
+    """ serves command, apt, facts, status and stop requests """
+
+    def __init__(self, path=SOCKET_PATH, idle=600, keepalive=30):
+        self.path = path
+        self.pool = ConnectionPool(idle, keepalive)
+        self.server = None
+
+    def dispatch(self, request, send):
+        from aptmachine import AptMachine
+        op = request.get('op')
+        if op == 'status':
+            send({'lines': self.pool.status()})
+            return
+        if op == 'stop':
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        color = request.get('color', False)
+        runner = PooledRunner(self.pool, send, request.get('parallel', 1), color)
+
+        def worker(server, report):
+            apt_cmd = runner.connect(debug=request.get('verbose', False), apt_command=request.get('apt_executable', AptMachine.apt_executable),
+                                     simulate=request.get('simulate', False), **server)
+            try:
+                if op == 'command':
+                    report.write(apt_cmd._execute(request['command']))
+                elif op == 'apt':
+                    report.write(apt_cmd.execute_apt(request['command'], request.get('packages') or list(), request.get('options', list())))
+                elif op == 'facts':
+                    # cached facts are good enough unless they are older than max_age
+                    facts = apt_cmd.facts
+                    if facts is None or time.time() - facts.get('gathered', 0) > request.get('max_age', 300):
+                        facts = apt_cmd.gather_facts(selections=False)
+                        facts['gathered'] = time.time()
+                    report.write(format_facts(facts))
+                else:
+                    raise ValueError('Unknown request %r' % op)
+                report.write(colorize('[OK]', color and GREEN))
+            finally:
+                runner.release(apt_cmd)
+
+        runner.run(request.get('servers', list()), worker)
+
+    def _reap(self):
+        while True:
+            time.sleep(min(30, max(1, self.pool.idle / 4)))
+            self.pool.evict()
+
+    def serve(self):
+        """ serves requests until a stop request or KeyboardInterrupt """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.path):
+            try:
+                DaemonClient(self.path).request('status').next()
+                raise RuntimeError('Another yarapt daemon is listening on %s' % self.path)
+            except socket.error:
+                # left over from a daemon which didn't shut down cleanly
+                os.unlink(self.path)
+        # the connections may be root on every host, only our user may talk to the daemon
+        umask = os.umask(0177)
+        try:
+            self.server = _Server(self.path, _Handler)
+        finally:
+            os.umask(umask)
+        self.server.yarapt = self
+        reaper = threading.Thread(target=self._reap, name='yarapt-reaper')
+        reaper.daemon = True
+        reaper.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self.pool.close_all()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+class DaemonClient(object):
+    """ thin client of a running Daemon """
+
+    def __init__(self, path=SOCKET_PATH):
+        self.path = path
+
+    def request(self, op, **params):
+        """ sends one request, the messages of the daemon can be iterated over until it is done.
+            raises socket.error if no daemon is listening """
+        params['op'] = op
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.path)
+            connection.sendall(json.dumps(params) + '\n')
+        except socket.error:
+            connection.close()
+            raise
+        return self._messages(connection)
+
+    def _messages(self, connection):
+        try:
+            for line in connection.makefile('r'):
+                message = json.loads(line)
+                if message.get('done'):
+                    return
+                yield message
+        finally:
+            connection.close()
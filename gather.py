@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" gather mode: hosts with identical output are printed once, under a folded host range """
+
+import re
+import hashlib
+from runner import Runner
+from helpers import colorize, leet_equal_signs
+from helpers import RED, YELLOW
+
+# the last number in a host name is the one that gets folded
+NUMBERED = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+def fold_hosts(hosts):
+    """ compact label for a list of hosts, e.g. web[01-03,07],db1 """
+    groups = dict()
+    order = list()
+    for host in hosts:
+        match = NUMBERED.match(host or '')
+        if match:
+            prefix, number, suffix = match.groups()
+            # web1 and web01 are different hosts, zero padded numbers keep their width
+            key = (prefix, suffix, len(number) if len(number) > 1 and number.startswith('0') else 0)
+            numbers = groups.get(key)
+            if numbers is None:
+                numbers = groups[key] = set()
+                order.append(key)
+            numbers.add(int(number))
+        else:
+            key = (host, None, None)
+            if key not in groups:
+                groups[key] = None
+                order.append(key)
+    # web10 continues web08, web09
+    for prefix, suffix, width in order:
+        if suffix is not None and width and (prefix, suffix, 0) in groups:
+            unpadded = groups[(prefix, suffix, 0)]
+            wide = set(number for number in unpadded if len(str(number)) == width)
+            groups[(prefix, suffix, width)].update(wide)
+            unpadded.difference_update(wide)
+    labels = list()
+    for key in order:
+        prefix, suffix, width = key
+        numbers = groups[key]
+        if numbers is None:
+            labels.append(str(prefix))
+            continue
+        if not numbers:
+            continue
+        numbers = sorted(numbers)
+        ranges = list()
+        start = previous = numbers[0]
+        for number in numbers[1:] + [None]:
+            if number is not None and number == previous + 1:
+                previous = number
+                continue
+            if start == previous:
+                ranges.append('%0*d' % (width, start))
+            else:
+                ranges.append('%0*d-%0*d' % (width, start, width, previous))
+            start = previous = number
+        if len(numbers) == 1:
+            labels.append('%s%s%s' % (prefix, ranges[0], suffix))
+        else:
+            labels.append('%s[%s]%s' % (prefix, ','.join(ranges), suffix))
+    return ','.join(labels)
+
+class GatheringRunner(Runner):
+    """ Runner which prints nothing per host. every output is hashed as it arrives and kept
+        once, all hosts with the same output share it. the groups come with the summary. """
+
+    def __init__(self, parallel=1, color=False, tracer=None, quiet=False):
+        Runner.__init__(self, parallel, color, tracer, quiet)
+        # (ok, digest): [lines, hosts]
+        self.groups = dict()
+        self.order = list()
+
+    def show(self, report):
+        key = (report.ok, hashlib.sha1('\n'.join(report.lines)).digest())
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = [report.lines, list()]
+            self.order.append(key)
+        # the report keeps a reference to the shared copy only
+        report.lines = group[0]
+        group[1].append(report.host)
+
+    def render(self):
+        """ successful groups first, larger groups before smaller ones """
+        keys = sorted(self.order, key=lambda key: (not key[0], -len(self.groups[key][1])))
+        blocks = list()
+        for key in keys:
+            lines, hosts = self.groups[key]
+            label = '%s (%d)' % (fold_hosts(hosts), len(hosts))
+            blocks.append('\n'.join([colorize(leet_equal_signs(label), self.color and (YELLOW if key[0] else RED))] + lines))
+        return '\n'.join(blocks)
+
+    def summary(self, *notes):
+        return '\n'.join([block for block in (self.render(), Runner.summary(self, *notes)) if block])
@@ -4,11 +4,14 @@
 # shell color codes
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = [i + 30 for i in range(8)]
 
+def format_errors(ex, color=None):
+    """ helper function which turns an exception into colored lines """
+    return [colorize(error, color and RED) for error in str(ex).split('\n')]
+
 def print_errors(ex, color=None):
     """ helper function for less tracebacks """
-    error_list = str(ex).split('\n')
-    for error in error_list:
-        print colorize(error, color and RED)
+    for error in format_errors(ex, color):
+        print error
 
 def list_print(content_list, max_length=False):
     """ helper function which generates a string out of a list
@@ -26,6 +29,21 @@ def list_print(content_list, max_length=False):
             break
     return ", ".join(tmp)
 
+def chunk_arguments(arguments, max_length):
+    """ helper function which splits a list of arguments into lists
+        whose joined length stays below max_length """
+    chunk = []
+    length = 0
+    for argument in arguments:
+        if chunk and length + len(argument) + 1 > max_length:
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(argument)
+        length += len(argument) + 1
+    if chunk:
+        yield chunk
+
 def colorize(message, color, bold=True):
     """ helper function which gives us color in a terminal """
     if not color:
@@ -40,3 +58,33 @@ def leet_equal_signs(message, max_length=50):
     count = (max_length - len(message) - 2)/2.0
     output = "%s %s %s" % (int(count) * "=", message, int(round(count)) * "=")
     return output
+
+def utf8(value):
+    """ JSON hands out unicode, the rest of yarapt works with utf-8 byte strings """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [utf8(item) for item in value]
+    if isinstance(value, dict):
+        return dict((utf8(key), utf8(item)) for key, item in value.items())
+    return value
+
+class LineSplitter(object):
+    """ cuts a stream of output chunks into lines and hands every complete line
+        to callback(stream, line), the incomplete rest waits for the next chunk """
+
+    def __init__(self, stream, callback):
+        self.stream = stream
+        self.callback = callback
+        self._rest = ''
+
+    def feed(self, data):
+        lines = (self._rest + data).split('\n')
+        self._rest = lines.pop()
+        for line in lines:
+            self.callback(self.stream, line)
+
+    def flush(self):
+        if self._rest:
+            self.callback(self.stream, self._rest)
+            self._rest = ''
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" append-only journal of a sync run, so an interrupted run can be resumed """
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+class RunJournal(object):
+    """ one JSON object per line: the run with the reference's fingerprint and facts, every
+        completed phase of a host and every finished host. a new run replaces the file,
+        a resumed one appends to it. without writing, e.g. in simulate mode, nothing is
+        recorded but an earlier run can still be resumed. """
+
+    def __init__(self, path='./var/log/yarapt-sync.journal', tracer=None, writing=True):
+        self.path = path
+        self.tracer = tracer
+        self.writing = writing
+        self.run = None
+        self.previous = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ reads the last run, returns whether there is one to resume """
+        runs = dict()
+        last = None
+        try:
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # the last line of a crashed run may be cut off
+                        continue
+                    if event.get('event') == 'run':
+                        last = event['run']
+                        runs.setdefault(last, {'run': last, 'phases': dict(), 'finished': set()}).update(
+                            reference=event.get('reference'), fingerprint=event.get('fingerprint'), facts=event.get('facts'))
+                    elif event.get('run') in runs:
+                        state = runs[event['run']]
+                        if event.get('event') == 'phase':
+                            state['phases'].setdefault(event['host'], set()).add(event['phase'])
+                        elif event.get('event') == 'host':
+                            if event.get('ok'):
+                                state['finished'].add(event['host'])
+                            else:
+                                state['finished'].discard(event['host'])
+        except IOError:
+            pass
+        self.previous = runs.get(last)
+        return self.previous is not None
+
+    def forget(self):
+        """ the previous run can't be resumed, everything starts over """
+        self.previous = None
+
+    def _write(self, **event):
+        if not self.writing:
+            return
+        event['run'] = self.run
+        event['time'] = round(time.time(), 3)
+        with self._lock:
+            try:
+                self._file.write(json.dumps(event) + '\n')
+                self._file.flush()
+            except (IOError, ValueError, AttributeError), ex:
+                logging.warn('Could not write to journal %s: %s' % (self.path, ex))
+
+    def start(self, reference, fingerprint, facts):
+        """ begins a new run, or continues the previous one if it is resumed """
+        if self.previous:
+            self.run = self.previous['run']
+            mode = 'a'
+        else:
+            self.run = '%d-%d' % (time.time(), os.getpid())
+            mode = 'w'
+        if self.writing:
+            try:
+                self._file = open(self.path, mode)
+            except IOError, ex:
+                logging.warn('Could not open journal %s: %s' % (self.path, ex))
+        self._write(event='run', reference=reference, fingerprint=fingerprint, facts=facts)
+
+    def completed(self, host, name):
+        """ did host complete the phase name in the resumed run? """
+        return bool(self.previous) and name in self.previous['phases'].get(host, ())
+
+    def finished(self, host):
+        """ did host finish successfully in the resumed run? """
+        return bool(self.previous) and host in self.previous['finished']
+
+    @contextmanager
+    def phase(self, host, name):
+        """ times the enclosed block and records it as completed if it didn't raise """
+        if self.tracer:
+            with self.tracer.phase(host, name):
+                yield
+        else:
+            yield
+        self.done(host, name)
+
+    def done(self, host, name):
+        """ records the phase name of host as completed """
+        self._write(event='phase', host=host, phase=name)
+
+    def host(self, host, ok):
+        self._write(event='host', host=host, ok=ok)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" local counterpart of ssh.Connection.execute: runs a shell command without polling """
+
+import os
+import errno
+import select
+import signal
+import time
+from subprocess import Popen, PIPE
+from helpers import LineSplitter
+
+CHUNK_SIZE = 32768
+
+def _kill_group(proc):
+    """ kills the shell and everything it started """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    proc.wait()
+
+def execute(command, timeout=60, callback=None, stdin=None):
+    """ runs command in its own process group and reads stdout and stderr concurrently,
+        so no amount of output can block it. callback(stream, line) gets every line as it arrives,
+        stdin is written to the command while its output is read.
+        returns (stdout, stderr, returncode), returncode is None after a timeout. """
+    if stdin is None:
+        devnull = open(os.devnull)
+        try:
+            proc = Popen(command, shell=True, stdout=PIPE, stderr=PIPE, stdin=devnull, close_fds=True, preexec_fn=os.setsid)
+        finally:
+            devnull.close()
+        writers = []
+    else:
+        proc = Popen(command, shell=True, stdout=PIPE, stderr=PIPE, stdin=PIPE, close_fds=True, preexec_fn=os.setsid)
+        writers = [proc.stdin.fileno()]
+    written = 0
+    output = []
+    stderr = []
+    streams = {
+        proc.stdout.fileno(): (output, callback and LineSplitter('stdout', callback)),
+        proc.stderr.fileno(): (stderr, callback and LineSplitter('stderr', callback)),
+    }
+    deadline = timeout and time.time() + timeout
+    returncode = None
+    try:
+        while streams:
+            wait = None
+            if deadline:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    _kill_group(proc)
+                    return ''.join(output), ''.join(stderr), None
+            try:
+                readable, writable = select.select(streams.keys(), writers, [], wait)[:2]
+            except select.error, ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            if writable:
+                # a writable pipe takes PIPE_BUF bytes without blocking
+                try:
+                    written += os.write(writers[0], stdin[written:written + select.PIPE_BUF])
+                except OSError, ex:
+                    if ex.errno != errno.EPIPE:
+                        raise
+                    written = len(stdin)
+                if written >= len(stdin):
+                    proc.stdin.close()
+                    writers = []
+            for fd in readable:
+                chunks, splitter = streams[fd]
+                data = os.read(fd, CHUNK_SIZE)
+                if not data:
+                    del streams[fd]
+                    if splitter:
+                        splitter.flush()
+                    continue
+                chunks.append(data)
+                if splitter:
+                    splitter.feed(data)
+        # both pipes are closed, the shell is gone or about to exit
+        delay = 0.0001
+        while proc.poll() is None:
+            if deadline and time.time() > deadline:
+                _kill_group(proc)
+                return ''.join(output), ''.join(stderr), None
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        returncode = proc.returncode
+    finally:
+        proc.stdout.close()
+        proc.stderr.close()
+        if writers:
+            proc.stdin.close()
+        if returncode is None and proc.poll() is None:
+            _kill_group(proc)
+    return ''.join(output), ''.join(stderr), returncode
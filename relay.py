@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" relays: hosts in config.json which run yarapt themselves for the hosts below them.
+    a relay looks like any other server plus "relay": true and its subtree in "hosts",
+    "relay_command" says how yarapt is started there. the task goes to the relay's stdin
+    as one JSON object, every host it finished comes back as one marked line. """
+
+import sys
+import pipes
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from runner import HostReport
+
+RELAY_COMMAND = 'cd ~/yarapt && python yarapt.py relay'
+MARKER = '@@yarapt-relay@@ '
+
+def flatten(servers):
+    """ the servers without relays, their subtrees instead """
+    hosts = list()
+    for server in servers:
+        if server.get('relay'):
+            hosts.extend(flatten(server.get('hosts', list())))
+        else:
+            hosts.append(server)
+    return hosts
+
+def emit(report):
+    """ used in the relay process: hands one finished host to the controller """
+    sys.stdout.write(MARKER + json.dumps(report.to_dict()) + '\n')
+    sys.stdout.flush()
+
+def relay(apt_cmd, server, task, finish, color=False):
+    """ runs task on the relay apt_cmd is connected to. finish(report) gets the report of
+        every host of its subtree as soon as it is done, hosts the relay didn't report
+        count as failed. returns the relay's own output, e.g. its summary. """
+    task = dict(task, servers=server.get('hosts', list()), color=color)
+    notes = list()
+    reported = set()
+
+    def read_line(stream, line):
+        if stream == 'stdout' and line.startswith(MARKER):
+            report = HostReport.from_dict(json.loads(line[len(MARKER):]), color)
+            reported.add(report.host)
+            finish(report)
+        else:
+            notes.append(line)
+
+    try:
+        # the whole subtree is behind this one command, it takes as long as it takes
+        # one shell, a sudo prefix can't run cd on its own
+        command = '/bin/sh -c %s' % pipes.quote(server.get('relay_command', RELAY_COMMAND))
+        apt_cmd._execute(command, read_line, json.dumps(task), timeout=0)
+    finally:
+        for host in flatten(server.get('hosts', list())):
+            if host.get('host') not in reported:
+                report = HostReport(host, color)
+                report.ok = False
+                report.write('No result from relay %s' % server.get('host'))
+                finish(report)
+    return '\n'.join(notes)
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" client side of yarapt_remote.py: one long-lived channel per host answering framed requests """
+
+import os
+import zlib
+import struct
+import threading
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from helpers import utf8
+
+HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yarapt_remote.py')
+# whichever python the host has, the helper runs with both
+START_COMMAND = '/bin/sh -c \'exec "$(command -v python3 || command -v python)" %s\''
+
+class HelperError(Exception):
+    pass
+
+class RemoteHelper(object):
+    """ uploads the helper once (cached by content hash on the host) and keeps it running on
+        one channel. requests are a 4 byte length and JSON, responses a status byte, a 4 byte
+        length and zlib compressed JSON. one request at a time, callers are serialized. """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.channel = None
+        self._lock = threading.Lock()
+
+    def start(self, timeout=30):
+        remotepath = self.connection.put_cached(HELPER)
+        self.channel = self.connection.open_channel(START_COMMAND % remotepath)
+        return self.request('ping', timeout)
+
+    def request(self, op, timeout=None, **params):
+        """ sends one request and returns the decoded response, raises HelperError if the
+            helper reported an error and socket.timeout after timeout seconds. after a timeout
+            or a broken channel the helper is closed, the caller has to fall back. """
+        params['op'] = op
+        body = json.dumps(params)
+        with self._lock:
+            if self.channel is None:
+                raise HelperError('Remote helper is not running')
+            try:
+                self.channel.settimeout(timeout)
+                self.channel.sendall(struct.pack('>I', len(body)) + body)
+                status = self._read(1)
+                data = self._read(struct.unpack('>I', self._read(4))[0])
+            except Exception:
+                self._close()
+                raise
+        payload = utf8(json.loads(zlib.decompress(data)))
+        if status != 'O':
+            raise HelperError(payload.get('error', 'unknown error'))
+        return payload
+
+    def _read(self, size):
+        chunks = list()
+        while size > 0:
+            chunk = self.channel.recv(min(size, 65536))
+            if not chunk:
+                errors = ''
+                while self.channel.recv_stderr_ready():
+                    errors += self.channel.recv_stderr(65536)
+                raise HelperError('Remote helper exited: %s' % (errors.strip() or 'no message'))
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def _close(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+    def close(self):
+        """ closing its input ends the helper """
+        with self._lock:
+            self._close()
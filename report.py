@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" fleet drift report: a packages x hosts state matrix kept as bitsets """
+
+import threading
+from syncplan import STATE_NAMES
+
+ABSENT = 'absent'
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+def bit_numbers(bits):
+    """ numbers of all set bits, lowest first """
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+class DriftMatrix(object):
+    """ one integer per package and state, bit n is set if host number n has the package
+        in that state. host 0 is the reference. a host is added right after its list was
+        fetched, so only the matrix is kept and never all package lists at once. """
+
+    def __init__(self):
+        self.hosts = list()
+        self.packages = dict()
+        self._states = len(STATE_NAMES)
+        self._lock = threading.Lock()
+
+    def add(self, host, package_index):
+        """ adds a host with its {name: state code} index, returns its number """
+        with self._lock:
+            number = len(self.hosts)
+            self.hosts.append(host)
+            bit = 1 << number
+            packages = self.packages
+            for name, state in package_index.iteritems():
+                row = packages.get(name)
+                if row is None:
+                    row = packages[name] = [0] * self._states
+                row[state] |= bit
+            return number
+
+    def _all_hosts(self):
+        return (1 << len(self.hosts)) - 1
+
+    def reference_state(self, row):
+        """ state code of the reference host, None if it doesn't know the package """
+        for state, bits in enumerate(row):
+            if bits & 1:
+                return state
+        return None
+
+    def drift_mask(self, row):
+        """ all hosts whose state differs from the reference """
+        state = self.reference_state(row)
+        if state is None:
+            present = 0
+            for bits in row:
+                present |= bits
+            return present
+        return self._all_hosts() & ~row[state]
+
+    def breakdown(self, row):
+        """ {state name: host count} of all drifting hosts """
+        mask = self.drift_mask(row)
+        counts = dict()
+        present = 0
+        for state, bits in enumerate(row):
+            present |= bits
+            count = popcount(bits & mask)
+            if count:
+                counts[STATE_NAMES[state]] = count
+        absent = popcount(mask & ~present)
+        if absent:
+            counts[ABSENT] = absent
+        return counts
+
+    def drifting_packages(self):
+        """ [(host count, name)] of all packages not in the reference state everywhere, most drift first """
+        drifting = list()
+        for name, row in self.packages.iteritems():
+            count = popcount(self.drift_mask(row))
+            if count:
+                drifting.append((count, name))
+        drifting.sort(key=lambda item: (-item[0], item[1]))
+        return drifting
+
+    def host_drift(self):
+        """ [(package count, host)] differing from the reference, most drift first """
+        counts = [0] * len(self.hosts)
+        for row in self.packages.itervalues():
+            for number in bit_numbers(self.drift_mask(row)):
+                counts[number] += 1
+        drift = [(count, host) for host, count in zip(self.hosts, counts)[1:]]
+        drift.sort(key=lambda item: (-item[0], item[1]))
+        return drift
+
+    def render(self, top=20):
+        """ text report of the packages and hosts with the most drift """
+        drifting = self.drifting_packages()
+        lines = ['Hosts: %d, packages: %d, drifting packages: %d' % (len(self.hosts), len(self.packages), len(drifting))]
+        if not self.hosts:
+            return '\n'.join(lines)
+        lines.append('')
+        lines.append('Packages drifting on most hosts (reference: %s):' % self.hosts[0])
+        lines.append('  %-40s %6s  %-10s %s' % ('package', 'hosts', 'reference', 'drifting as'))
+        for count, name in drifting[:top]:
+            row = self.packages[name]
+            state = self.reference_state(row)
+            breakdown = ', '.join(['%s:%d' % item for item in sorted(self.breakdown(row).items())])
+            lines.append('  %-40s %6d  %-10s %s' % (name, count, ABSENT if state is None else STATE_NAMES[state], breakdown))
+        lines.append('')
+        lines.append('Hosts differing most from the reference:')
+        lines.append('  %-40s %8s' % ('host', 'packages'))
+        for count, host in self.host_drift()[:top]:
+            lines.append('  %-40s %8d' % (host, count))
+        return '\n'.join(lines)
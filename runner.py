@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" runs a task against many hosts, one after another or through a bounded worker pool """
+import sys
+import threading
+import time
+import Queue
+from tracer import Tracer
+from helpers import colorize, leet_equal_signs, format_errors, utf8
+from helpers import RED, GREEN, YELLOW
+
+# set in relay processes, see emit_reports()
+_emit = None
+# failed hosts of all runners in this process, see failed_hosts()
+_failed = 0
+_failed_lock = threading.Lock()
+
+def emit_reports(callback):
+    """ reports of all runners which are not quiet go to callback(report) instead of being printed """
+    global _emit
+    _emit = callback
+
+def failed_hosts():
+    """ how many hosts failed in any runner of this process so far, e.g. for the exit code """
+    return _failed
+
+class HostReport(object):
+    """ buffered output of one host, printed as one block when the host is done """
+
+    def __init__(self, server, color=False):
+        self.server = server
+        self.host = server.get('host')
+        self.color = color
+        self.lines = list()
+        self.ok = True
+        self.duration = 0.0
+        # False for reports which only carry notes, e.g. of a relay whose hosts are reported on their own
+        self.counted = True
+
+    def write(self, *messages):
+        """ behaves like the print statement, but into the buffer """
+        self.lines.append(' '.join([str(message) for message in messages]))
+
+    def error(self, ex):
+        """ records an error, the host counts as failed afterwards """
+        self.ok = False
+        self.lines.extend(format_errors(ex, self.color))
+
+    def to_dict(self):
+        return {'host': self.host, 'ok': self.ok, 'lines': self.lines, 'duration': self.duration}
+
+    @classmethod
+    def from_dict(cls, data, color=False):
+        """ report of a host processed elsewhere (daemon, relay) """
+        data = utf8(data)
+        report = cls({'host': data['host']}, color)
+        report.lines, report.ok, report.duration = data['lines'], data['ok'], data['duration']
+        return report
+
+    def __str__(self):
+        header = colorize(leet_equal_signs(self.host), self.color and YELLOW)
+        return '\n'.join([header] + self.lines)
+
+class Runner(object):
+    """ runs worker(server, report) for every server with at most `parallel` hosts at once.
+        every AptMachine opened by connect() gets closed, even on failures and interrupts.
+        quiet runners only print the output of failed hosts. """
+
+    def __init__(self, parallel=1, color=False, tracer=None, quiet=False):
+        self.parallel = max(1, parallel or 1)
+        self.color = color
+        self.quiet = quiet
+        self.tracer = tracer or Tracer()
+        self.reports = list()
+        self.failed = 0
+        self.started = time.time()
+        self._machines = set()
+        self._lock = threading.Lock()
+        self._finish_lock = threading.Lock()
+
+    def connect(self, **kwargs):
+        """ opens an AptMachine which is tracked until release() """
+        # imported here, paramiko is not needed to print reports of a daemon
+        from aptmachine import AptMachine
+        with self.tracer.phase(kwargs.get('host'), 'connect'):
+            apt_cmd = AptMachine(tracer=self.tracer, **kwargs)
+        with self._lock:
+            self._machines.add(apt_cmd)
+        return apt_cmd
+
+    def release(self, apt_cmd):
+        """ closes an AptMachine opened by connect() """
+        with self._lock:
+            self._machines.discard(apt_cmd)
+        try:
+            apt_cmd.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        """ closes every connection which is still open """
+        with self._lock:
+            machines = list(self._machines)
+            self._machines.clear()
+        for apt_cmd in machines:
+            try:
+                apt_cmd.close()
+            except Exception:
+                pass
+        # no ssh connection was ever opened if the module isn't loaded
+        ssh = sys.modules.get('ssh')
+        if ssh:
+            ssh.close_all()
+
+    def _run_one(self, server, worker):
+        report = HostReport(server, self.color)
+        start_time = time.time()
+        try:
+            worker(server, report)
+        except Exception, ex:
+            report.error(ex)
+        report.duration = time.time() - start_time
+        self.tracer.record('phase', report.host, 'host', report.duration, ok=report.ok)
+        return report
+
+    def finish(self, report):
+        """ counts a finished host and shows its report. workers may call it for hosts they
+            processed on behalf of others, e.g. the subtree of a relay """
+        global _failed
+        with self._finish_lock:
+            if not report.counted:
+                if report.lines and not self.quiet:
+                    print report
+                return
+            self.reports.append(report)
+            if not report.ok:
+                self.failed += 1
+                with _failed_lock:
+                    _failed += 1
+            if _emit and not self.quiet:
+                _emit(report)
+            elif not (report.ok and self.quiet):
+                self.show(report)
+
+    def show(self, report):
+        print report
+
+    def run(self, servers, worker, stop=None):
+        """ processes all servers, printing each host's output as soon as it is complete.
+            stop() is asked before each host is started, once it returns True no further
+            host is started. returns the servers which were not started. """
+        skipped = list()
+        try:
+            if self.parallel == 1 or len(servers) < 2:
+                for number, server in enumerate(servers):
+                    if stop and stop():
+                        skipped.extend(servers[number:])
+                        break
+                    self.finish(self._run_one(server, worker))
+                return skipped
+            tasks = Queue.Queue()
+            results = Queue.Queue()
+            for server in servers:
+                tasks.put(server)
+
+            def consume():
+                while True:
+                    try:
+                        server = tasks.get_nowait()
+                    except Queue.Empty:
+                        return
+                    if stop and stop():
+                        skipped.append(server)
+                        continue
+                    results.put(self._run_one(server, worker))
+
+            for i in range(min(self.parallel, len(servers))):
+                thread = threading.Thread(target=consume, name='yarapt-worker-%d' % i)
+                thread.daemon = True
+                thread.start()
+            done = 0
+            while done + len(skipped) < len(servers):
+                try:
+                    # a timeout keeps the main thread responsive to KeyboardInterrupt
+                    report = results.get(timeout=0.2)
+                except Queue.Empty:
+                    continue
+                self.finish(report)
+                done += 1
+            return skipped
+        except KeyboardInterrupt:
+            self.close_all()
+            raise
+
+    def summary(self, *notes):
+        """ one line per outcome over all hosts processed so far, followed by notes """
+        failed = [report.host for report in self.reports if not report.ok]
+        lines = [colorize(leet_equal_signs('Summary'), self.color and YELLOW)]
+        lines.append('Hosts: %d, ok: %d, failed: %d, duration: %.1fs' % (
+            len(self.reports), len(self.reports) - len(failed), len(failed), time.time() - self.started))
+        if failed:
+            lines.append(colorize('Failed: %s' % ', '.join(failed), self.color and RED))
+        lines.extend(notes)
+        if not failed:
+            lines.append(colorize('[OK]', self.color and GREEN))
+        return '\n'.join(lines)
@@ -7,51 +7,165 @@ import sys
 import logging
 import getpass
 import time
+import select
+import threading
+import hashlib
+import Queue
 try:
     import paramiko
 except ImportError:
     print "Package python-paramiko is missing. Please install it."
     sys.exit(1)
 
+import socket
 from socket import timeout
+from helpers import LineSplitter
+
+# Keys and authenticated transports are shared by all connections of a run:
+# one passphrase prompt and one handshake per host, no matter how many
+# AptMachines are using it.
+KEY_CLASSES = [getattr(paramiko, name) for name in ('RSAKey', 'DSSKey', 'ECDSAKey', 'Ed25519Key') if hasattr(paramiko, name)]
+_key_lock = threading.Lock()
+_keys = {}
+_agent_keys = None
+_pool_lock = threading.Lock()
+_host_locks = {}
+_transports = {}
+
+def _agent():
+    """Keys offered by a running ssh-agent, asked for once per run."""
+    global _agent_keys
+    with _key_lock:
+        if _agent_keys is None:
+            try:
+                _agent_keys = list(paramiko.Agent().get_keys())
+            except Exception:
+                _agent_keys = []
+        return _agent_keys
+
+def load_key(private_key):
+    """Loads and decrypts a private key file, asking for its passphrase at most once per run."""
+    private_key_file = os.path.expanduser(private_key)
+    with _key_lock:
+        if private_key_file in _keys:
+            return _keys[private_key_file]
+        password = None
+        key = None
+        while key is None:
+            errors = []
+            for key_class in KEY_CLASSES:
+                try:
+                    key = key_class.from_private_key_file(private_key_file, password)
+                    break
+                except paramiko.PasswordRequiredException:
+                    if password is not None:
+                        raise
+                    password = getpass.getpass('Password for key %s: ' % private_key)
+                    break
+                except paramiko.SSHException, ex:
+                    errors.append(str(ex))
+            else:
+                raise paramiko.SSHException('Could not load key %s: %s' % (private_key, '; '.join(errors)))
+        _keys[private_key_file] = key
+        return key
+
+def _authenticate(transport, username, private_key=None, password=None):
+    """Authenticates a started transport with password, agent keys or key file."""
+    if password:
+        # Using Password.
+        transport.auth_password(username, password)
+        return
+    for key in _agent():
+        try:
+            transport.auth_publickey(username, key)
+            return
+        except paramiko.AuthenticationException:
+            pass
+    # Use Private Key.
+    if not private_key:
+        # Try to use default key.
+        if os.path.exists(os.path.expanduser('~/.ssh/id_rsa')):
+            private_key = '~/.ssh/id_rsa'
+        elif os.path.exists(os.path.expanduser('~/.ssh/id_dsa')):
+            private_key = '~/.ssh/id_dsa'
+        else:
+            raise TypeError, "You have not specified a password or key."
+    transport.auth_publickey(username, load_key(private_key))
+
+def _acquire_transport(host, port, username, private_key, password):
+    """Returns the shared transport for host, connecting it first if needed."""
+    pool_key = (host, port, username)
+    with _pool_lock:
+        host_lock = _host_locks.setdefault(pool_key, threading.Lock())
+    with host_lock:
+        with _pool_lock:
+            shared = _transports.get(pool_key)
+            if shared and shared[0].is_active():
+                shared[1] += 1
+                return shared[0]
+        transport = paramiko.Transport((host, port))
+        # commands are small request/response exchanges, don't let Nagle hold them back
+        transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            transport.start_client()
+            _authenticate(transport, username, private_key, password)
+        except:
+            transport.close()
+            raise
+        with _pool_lock:
+            _transports[pool_key] = [transport, 1]
+        return transport
+
+def _release_transport(transport):
+    """Closes a shared transport once its last user is gone."""
+    with _pool_lock:
+        for pool_key, shared in _transports.items():
+            if shared[0] is transport:
+                shared[1] -= 1
+                if shared[1] > 0:
+                    return
+                del _transports[pool_key]
+                break
+    transport.close()
+
+def close_all():
+    """Closes every shared transport, e.g. at the end of a run."""
+    with _pool_lock:
+        shared = _transports.values()
+        _transports.clear()
+    for transport, users in shared:
+        transport.close()
 
 class Connection(object):
     """Connects and logs into the specified hostname. 
-    Arguments that are not given are guessed from the environment."""
+    Arguments that are not given are guessed from the environment.
+    Connections to the same host and user share one authenticated transport,
+    commands can run concurrently on their own channels."""
+    CHUNK_SIZE = 32768
+    # upper bound for a single wait, exit status alone does not wake up select
+    POLL_LIMIT = 1.0
 
     def __init__(self, host, username=None, private_key=None, password=None, port=22, level=logging.DEBUG):
         self._sftp_live = False
         self._sftp = None
+        self._tranport_live = False
+        self.returncode = None
         if not username:
             username = os.environ['LOGNAME']
 
         paramiko.util.log_to_file('/dev/null', level=level)
 
-        # Begin the SSH transport.
-        self._transport = paramiko.Transport((host, port))
+        # Begin the SSH transport, or reuse the one already open for this host.
+        self._transport = _acquire_transport(host, port, username, private_key, password)
         self._tranport_live = True
-        # Authenticate the transport.
-        if password:
-            # Using Password.
-            self._transport.connect(username=username, password=password)
-        else:
-            # Use Private Key.
-            if not private_key:
-                # Try to use default key.
-                if os.path.exists(os.path.expanduser('~/.ssh/id_rsa')):
-                    private_key = '~/.ssh/id_rsa'
-                elif os.path.exists(os.path.expanduser('~/.ssh/id_dsa')):
-                    private_key = '~/.ssh/id_dsa'
-                else:
-                    raise TypeError, "You have not specified a password or key."
-
-            private_key_file = os.path.expanduser(private_key)
-            try:
-                rsa_key = paramiko.RSAKey.from_private_key_file(private_key_file)
-            except paramiko.PasswordRequiredException:
-                password = getpass.getpass('RSA key password: ')
-                rsa_key = paramiko.RSAKey.from_private_key_file(private_key_file, password)
-            self._transport.connect(username=username, pkey=rsa_key)
+
+    def is_active(self):
+        """Whether the shared transport is still connected."""
+        return self._tranport_live and self._transport.is_active()
+
+    def set_keepalive(self, interval):
+        """Sends a keepalive every interval seconds, so idle connections survive NAT and firewalls."""
+        self._transport.set_keepalive(interval)
 
     def _sftp_connect(self):
         """Establish the SFTP connection."""
@@ -73,49 +187,164 @@ class Connection(object):
         self._sftp_connect()
         self._sftp.put(localpath, remotepath)
 
-    def execute(self, command, timeout=10):
-        """Execute the given commands on a remote machine."""
+    def put_cached(self, localpath, directory='.cache/yarapt'):
+        """Uploads a file unless the remote host already has this exact content.
+        The remote name carries a hash of the content, so a changed file gets a new name.
+        Returns the remote path, relative paths are below the login directory."""
+        with open(localpath, 'rb') as local_file:
+            digest = hashlib.sha1(local_file.read()).hexdigest()[:12]
+        name, extension = os.path.splitext(os.path.basename(localpath))
+        remotepath = '%s/%s-%s%s' % (directory, name, digest, extension)
+        self._sftp_connect()
+        try:
+            self._sftp.stat(remotepath)
+            return remotepath
+        except IOError:
+            pass
+        parts = directory.split('/')
+        for number in range(1, len(parts) + 1):
+            path = '/'.join(parts[:number])
+            if path:
+                try:
+                    self._sftp.mkdir(path)
+                except IOError:
+                    pass
+        # upload under a temporary name, a half written helper must never look complete
+        self._sftp.put(localpath, remotepath + '.tmp')
+        self._sftp.posix_rename(remotepath + '.tmp', remotepath)
+        return remotepath
+
+    def open_channel(self, command):
+        """Starts command on a channel of its own and returns the channel,
+        for long running commands which talk over stdin and stdout."""
         channel = self._transport.open_session()
-        channel.setblocking(0)
         channel.set_combine_stderr(False)
-        channel.settimeout(0)
-        #channel.invoke_shell()
-        output = ''
-        stderr = ''
         channel.exec_command(command)
-        #channel.send(command + '\n')
-        duration = 0
-        start_time = time.time()
+        return channel
 
-        self.returncode = None
-        while not channel.exit_status_ready():
-            duration = time.time() - start_time
-            if timeout and duration > timeout:
-                break
-            time.sleep(0.1)
+    def _transfer_many(self, method, files, parallel):
+        """Copies (source, destination) pairs over up to parallel SFTP sessions at once.
+        Paramiko already pipelines the requests within one file, the sessions
+        keep several files in flight on the same transport."""
+        pending = Queue.Queue()
+        for item in files:
+            pending.put(item)
+        errors = []
 
-        while channel.recv_stderr_ready():
-            stderr += channel.recv_stderr(1024)
-        while channel.recv_ready():
-            output += channel.recv(1024)
+        def work():
+            try:
+                sftp = paramiko.SFTPClient.from_transport(self._transport)
+            except Exception, ex:
+                errors.append(ex)
+                return
+            try:
+                while not errors:
+                    try:
+                        source, destination = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    getattr(sftp, method)(source, destination)
+            except Exception, ex:
+                errors.append(ex)
+            finally:
+                sftp.close()
 
-        #import pdb
-        #pdb.set_trace()
-        if channel.exit_status_ready():
-            self.returncode = channel.recv_exit_status()
-        channel.close()
+        threads = [threading.Thread(target=work) for number in range(min(max(1, parallel), pending.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def get_many(self, files, parallel=4):
+        """Copies (remotepath, localpath) pairs from the remote host, several at once."""
+        self._transfer_many('get', files, parallel)
+
+    def put_many(self, files, parallel=4):
+        """Copies (localpath, remotepath) pairs to the remote host, several at once."""
+        self._transfer_many('put', files, parallel)
+
+    def execute(self, command, timeout=10, callback=None, stdin=None):
+        """Execute the given command on a remote machine.
+        Returns (stdout, stderr) and sets self.returncode, see run()."""
+        output, stderr, self.returncode = self.run(command, timeout, callback, stdin)
         return output, stderr
 
+    def run(self, command, timeout=10, callback=None, stdin=None):
+        """Execute the given command on its own channel, returns (stdout, stderr, returncode).
+        Both output streams are drained while the command runs, so a chatty
+        command never stalls on a full channel window. If given,
+        callback(stream, line) is called for every line as it arrives.
+        returncode is None if the command did not finish within timeout.
+        stdin is sent to the command before its input is closed.
+        Safe to call from several threads at once."""
+        channel = self._transport.open_session()
+        channel.set_combine_stderr(False)
+        channel.exec_command(command)
+        if stdin:
+            channel.sendall(stdin)
+        channel.shutdown_write()
+        output = []
+        stderr = []
+        splitters = None
+        if callback:
+            splitters = (LineSplitter('stdout', callback), LineSplitter('stderr', callback))
+        deadline = timeout and time.time() + timeout
+
+        returncode = None
+        try:
+            while True:
+                received = self._drain(channel, output, stderr, splitters)
+                if channel.exit_status_ready() and not received:
+                    returncode = channel.recv_exit_status()
+                    break
+                wait = self.POLL_LIMIT
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    wait = min(wait, remaining)
+                # the channel's pipe becomes readable on new data, eof and close
+                select.select([channel], [], [], wait)
+        finally:
+            channel.close()
+        if splitters:
+            for splitter in splitters:
+                splitter.flush()
+        return ''.join(output), ''.join(stderr), returncode
+
+    def _drain(self, channel, output, stderr, splitters=None):
+        """Reads everything buffered on the channel, returns whether anything was read."""
+        received = False
+        while channel.recv_ready():
+            data = channel.recv(self.CHUNK_SIZE)
+            if not data:
+                break
+            output.append(data)
+            if splitters:
+                splitters[0].feed(data)
+            received = True
+        while channel.recv_stderr_ready():
+            data = channel.recv_stderr(self.CHUNK_SIZE)
+            if not data:
+                break
+            stderr.append(data)
+            if splitters:
+                splitters[1].feed(data)
+            received = True
+        return received
+
     def close(self):
         """Closes the connection and cleans up."""
         # Close SFTP Connection.
         if self._sftp_live:
             self._sftp.close()
             self._sftp_live = False
-        # Close the SSH Transport.
+        # Release the SSH Transport, the last user closes it.
         if self._tranport_live:
-            self._transport.close()
             self._tranport_live = False
+            _release_transport(self._transport)
 
     def __del__(self):
         """Attempt to clean up if not explicitly closed."""
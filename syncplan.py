@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" compares package states of a host with the master server in a single pass """
+
+import hashlib
+import logging
+import threading
+
+# small integer codes for the dpkg selection states
+INSTALL, DEINSTALL, PURGE, HOLD, UNKNOWN = range(5)
+STATES = {'install': INSTALL, 'deinstall': DEINSTALL, 'purge': PURGE, 'hold': HOLD}
+STATE_NAMES = dict((code, name) for name, code in STATES.items())
+STATE_NAMES[UNKNOWN] = 'unknown'
+
+class PackageIndex(dict):
+    """ {name: state code}, remembers the names per state once they were asked for
+        until the index is changed """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._names = None
+
+    def __setitem__(self, name, state):
+        dict.__setitem__(self, name, state)
+        self._names = None
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name)
+        self._names = None
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._names = None
+
+    def names(self, state):
+        """ all package names in the given state """
+        if self._names is None:
+            self._names = dict((code, list()) for code in STATE_NAMES)
+            for name, code in self.iteritems():
+                self._names[code].append(name)
+        return self._names[state]
+
+def build_index(package_list):
+    """ turns [[name, state], ...] into {name: state code}, package names are interned
+        so that the indexes of all hosts share their strings """
+    index = PackageIndex()
+    # the names cache is still empty, no need to go through __setitem__
+    set_state = dict.__setitem__
+    malformed = 0
+    for package in package_list:
+        if len(package) == 2:
+            set_state(index, intern(package[0]), STATES.get(package[1], UNKNOWN))
+        else:
+            malformed += 1
+    if malformed:
+        logging.info('Skipped %d malformed package entries' % malformed)
+    return index
+
+class SyncPlan(object):
+    """ all changes needed to bring a host to the state of the master server:
+            missing   -> master install, host not install
+            redundant -> master deinstall, host install
+            purged    -> master purge, host install
+            held      -> master hold, host not hold
+        the master index is built once and shared between all targets, its names
+        per state are grouped only once, so every target costs one lookup per master package. """
+
+    def __init__(self, master_index, host_index):
+        get_state = host_index.get
+        if not isinstance(master_index, PackageIndex):
+            master_index = PackageIndex(master_index)
+        self.missing = [name for name in master_index.names(INSTALL) if get_state(name) != INSTALL]
+        self.held = [name for name in master_index.names(HOLD) if get_state(name) != HOLD]
+        self.redundant = [name for name in master_index.names(DEINSTALL) if get_state(name) == INSTALL]
+        self.purged = [name for name in master_index.names(PURGE) if get_state(name) == INSTALL]
+
+    def __len__(self):
+        return len(self.missing) + len(self.redundant) + len(self.purged) + len(self.held)
+
+def selections_digest(package_list):
+    """ content hash of a package list, equal for hosts with identical selections """
+    digest = hashlib.sha1()
+    for package in package_list:
+        digest.update(' '.join(package))
+        digest.update('\n')
+    return digest.hexdigest()
+
+class PlanGroups(object):
+    """ targets with the same group key (identical selections, apt lists and system) share one
+        SyncPlan and, on request, everything else computed for the group, e.g. the output of
+        an apt-get -s simulation. the first member computes, the others wait and reuse it. """
+
+    def __init__(self, master_index):
+        self.master_index = master_index
+        self.targets = 0
+        self._groups = dict()
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """ registers a target as member of the group key """
+        with self._lock:
+            self.targets += 1
+            group = self._groups.setdefault(key, {'lock': threading.Lock(), 'results': dict()})
+        return group
+
+    def shared(self, key, name, compute):
+        """ result of compute() for the group, computed only once unless it raised """
+        with self._lock:
+            group = self._groups.setdefault(key, {'lock': threading.Lock(), 'results': dict()})
+        with group['lock']:
+            if name not in group['results']:
+                group['results'][name] = compute()
+            return group['results'][name]
+
+    def plan(self, key, host_index):
+        return self.shared(key, 'plan', lambda: SyncPlan(self.master_index, host_index))
+
+    def summary(self):
+        return 'Plan groups: %d for %d targets' % (len(self._groups), self.targets)
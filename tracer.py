@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" timing of commands and sync phases, written as JSON lines and summarized per phase """
+
+import math
+import time
+import threading
+from contextlib import contextmanager
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+def percentile(values, fraction):
+    """ nearest-rank percentile of an already sorted list """
+    if not values:
+        return 0.0
+    index = max(0, int(math.ceil(fraction * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+class Tracer(object):
+    """ collects timed events per host. with a path every event is appended to it as one
+        JSON object per line, durations are always kept for the table at the end of the run """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._file = None
+        if path:
+            self._file = open(path, 'a')
+        self._durations = dict()
+        self._lock = threading.Lock()
+
+    def record(self, kind, host, name, duration, **fields):
+        event = dict(fields)
+        event.update({'time': round(time.time(), 6), 'kind': kind, 'host': host, 'name': name, 'duration': round(duration, 6)})
+        with self._lock:
+            self._durations.setdefault(name if kind == 'phase' else kind, list()).append(duration)
+            if self._file:
+                self._file.write(json.dumps(event) + '\n')
+                self._file.flush()
+
+    def command(self, host, command, duration, received, returncode):
+        """ one executed command: bytes received on stdout and stderr and its return code """
+        self.record('command', host, command, duration, received=received, returncode=returncode)
+
+    @contextmanager
+    def phase(self, host, name):
+        """ times the enclosed block, failures are recorded as well """
+        start_time = time.time()
+        failed = False
+        try:
+            yield
+        except:
+            failed = True
+            raise
+        finally:
+            self.record('phase', host, name, time.time() - start_time, failed=failed)
+
+    def table(self):
+        """ count, p50, p95, max and total duration per phase """
+        lines = ['%-12s %6s %9s %9s %9s %10s' % ('phase', 'count', 'p50', 'p95', 'max', 'total')]
+        with self._lock:
+            durations = sorted(self._durations.items())
+        for name, values in durations:
+            values = sorted(values)
+            lines.append('%-12s %6d %8.3fs %8.3fs %8.3fs %9.3fs' % (
+                name, len(values), percentile(values, 0.5), percentile(values, 0.95), values[-1], sum(values)))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" follows the dpkg.log of the reference host and turns new entries into small delta indexes """
+
+import time
+import pipes
+import logging
+from syncplan import PackageIndex, STATES, UNKNOWN
+
+# dpkg.log actions which name a package as their first argument
+ACTIONS = ('install', 'upgrade', 'remove', 'purge')
+
+def parse_dpkg_log(data, architecture=None):
+    """ names of all packages touched by the dpkg.log lines in data. dpkg logs name:arch,
+        the selections leave out the native architecture and all """
+    names = set()
+    for line in data.split('\n'):
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        if fields[2] in ACTIONS:
+            package = fields[3]
+        elif fields[2] == 'status' and len(fields) >= 5:
+            package = fields[4]
+        else:
+            continue
+        name, _, arch = package.partition(':')
+        if arch and arch not in (architecture, 'all'):
+            name = package
+        names.add(name)
+    return names
+
+class ReferenceWatcher(object):
+    """ polls fingerprint and dpkg.log of the reference in one command. only the part of the
+        log written since the last poll is transferred. the states of the packages named there
+        are asked for and compared with the master index. changes that leave no trace in the
+        log (e.g. holds set with dpkg --set-selections), a rotated log and every rescan interval
+        lead to a full comparison of the selections instead. """
+    MARKER = '@@yarapt-end@@'
+
+    def __init__(self, apt_cmd, master_index, rescan=300, limit=1048576):
+        self.apt_cmd = apt_cmd
+        self.master_index = master_index
+        self.rescan = rescan
+        self.limit = limit
+        self.fingerprint = None
+        self.offset = None
+        self.last_scan = time.time()
+
+    def _probe(self, offset):
+        """ (fingerprint, log size, new log data) """
+        log = pipes.quote(self.apt_cmd.DPKG_LOG)
+        script = [
+            'echo $(%s)' % self.apt_cmd.FINGERPRINT_COMMAND,
+            '/usr/bin/stat -c %%s %s 2>/dev/null || echo 0' % log,
+            'if [ "$(/usr/bin/stat -c %%s %s 2>/dev/null || echo 0)" -gt %d ]; then /usr/bin/tail -c +%d %s | /usr/bin/head -c %d; fi' % (
+                log, offset, offset + 1, log, self.limit),
+            'echo; echo %s' % self.MARKER,
+        ]
+        output = self.apt_cmd._execute('/bin/sh -c %s' % pipes.quote('; '.join(script)))
+        fingerprint, size, rest = output.split('\n', 2)
+        # the echo in front of the marker added one newline
+        data = rest[:rest.rindex(self.MARKER)][:-1]
+        return ' '.join(fingerprint.split()), int(size), data
+
+    def start(self, fingerprint):
+        """ starts following the log at its current end """
+        self.fingerprint = fingerprint
+        self.offset = self._probe(0x7fffffff)[1]
+
+    def _changes(self, states):
+        """ delta index of all packages whose state differs from the master index """
+        delta = PackageIndex()
+        for name, state in states.items():
+            code = STATES.get(state, UNKNOWN)
+            if self.master_index.get(name) != code:
+                delta[name] = code
+        return delta
+
+    def _full_scan(self):
+        fingerprint, package_list = self.apt_cmd.get_selections()
+        states = dict((package[0], package[1]) for package in package_list if len(package) == 2)
+        # whatever vanished from the selections is gone for good
+        for name in self.master_index:
+            if name not in states:
+                states[name] = 'purge'
+        self.last_scan = time.time()
+        return fingerprint, self._changes(states)
+
+    def poll(self):
+        """ delta index of the changes since the last poll (empty if there were none),
+            the master index is updated with them """
+        fingerprint, size, data = self._probe(self.offset)
+        if size < self.offset or len(data) >= self.limit:
+            logging.info('dpkg.log of %s was rotated or grew too fast, comparing all selections' % self.apt_cmd.host)
+            self.offset = size
+            names = None
+        else:
+            # an incomplete last line is read again next time
+            complete = data[:data.rfind('\n') + 1]
+            self.offset += len(complete)
+            names = parse_dpkg_log(complete, self.apt_cmd.architecture)
+        rescan = self.rescan and time.time() - self.last_scan > self.rescan
+        if fingerprint == self.fingerprint and not rescan:
+            return PackageIndex()
+        if rescan or not names:
+            fingerprint, delta = self._full_scan()
+        else:
+            states = self.apt_cmd.package_states(sorted(names))
+            for name in names:
+                states.setdefault(name, 'purge')
+            delta = self._changes(states)
+        self.fingerprint = fingerprint
+        self.master_index.update(delta)
+        return delta
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" rolls a task out in waves: canary first, tagged groups with their own concurrency, a failure budget """
+
+import os
+import logging
+import threading
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from helpers import colorize, list_print
+from helpers import GREEN, RED
+
+def load_config(config):
+    """ config.json is either the plain server list or {"servers": [...], "waves": [...], ...},
+        returns (servers with the reference first, schedule settings) """
+    if isinstance(config, dict):
+        servers = config.get('servers', list())
+        settings = dict((key, value) for key, value in config.items() if key != 'servers')
+    else:
+        servers = config
+        settings = dict()
+    return sorted(servers, key=lambda k: k.get('reference'), reverse=True), settings
+
+def host_tags(server):
+    """ tags of a server, its group counts as a tag as well """
+    tags = set(server.get('tags', list()))
+    if server.get('group'):
+        tags.add(server['group'])
+    return tags
+
+class RuntimeHistory(object):
+    """ smoothed run time per host from earlier runs of the same task, the slowest hosts are
+        started first. without recording, e.g. for simulated runs, the history is only read """
+
+    def __init__(self, task, directory='./var/cache/yarapt', weight=0.5, recording=True):
+        self.path = os.path.join(directory, 'runtimes-%s.json' % task)
+        self.weight = weight
+        self.recording = recording
+        self.runtimes = dict()
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as history:
+                self.runtimes = json.load(history)
+        except (IOError, ValueError):
+            pass
+
+    def get(self, host):
+        return self.runtimes.get(host)
+
+    def order(self, servers):
+        """ slowest first, hosts without history count as slowest """
+        return sorted(servers, key=lambda server: -self.runtimes.get(server.get('host'), float('inf')))
+
+    def update(self, reports):
+        """ takes the durations of finished HostReports into account """
+        if not self.recording:
+            return
+        with self._lock:
+            for report in reports:
+                previous = self.runtimes.get(report.host)
+                if previous is None:
+                    self.runtimes[report.host] = round(report.duration, 3)
+                else:
+                    self.runtimes[report.host] = round(self.weight * report.duration + (1 - self.weight) * previous, 3)
+
+    def save(self):
+        """ replaces the history file atomically """
+        if not self.recording:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with self._lock:
+                with open(tmp_path, 'w') as history:
+                    json.dump(self.runtimes, history)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), ex:
+            logging.warn('Could not write run times to %s: %s' % (self.path, ex))
+
+class WaveScheduler(object):
+    """ splits the servers into waves which run one after another. settings (from config.json):
+            waves:          [{"name": ..., "tags": [...], "limit": N, "parallel": N}, ...]
+                            a wave takes the remaining hosts with any of its tags (all without tags),
+                            at most limit of them, and runs parallel of them at once
+            canary:         a first wave of this many hosts, tagged "canary" ones preferred,
+                            a single failure there stops the rollout
+            failure_budget: number of failed hosts after which no further host is started
+        hosts no wave took run in a last wave. within a wave the slowest hosts start first. """
+
+    def __init__(self, settings=None, parallel=1, history=None, color=False):
+        settings = settings or dict()
+        self.waves = settings.get('waves', list())
+        self.canary = settings.get('canary', 0)
+        self.failure_budget = settings.get('failure_budget')
+        self.parallel = parallel
+        self.history = history
+        self.color = color
+        self.skipped = list()
+        self.stopped = None
+        self._failed_before = 0
+
+    def plan(self, servers):
+        """ [(name, parallel, servers)] in the order they run """
+        remaining = list(servers)
+        waves = list()
+
+        def take(wanted, limit=None):
+            chosen = [server for server in remaining if wanted(server)]
+            if limit is not None:
+                chosen = chosen[:limit]
+            for server in chosen:
+                remaining.remove(server)
+            return chosen
+
+        if self.canary:
+            canaries = take(lambda server: 'canary' in host_tags(server), self.canary)
+            canaries.extend(take(lambda server: True, self.canary - len(canaries)))
+            waves.append(('canary', 1, canaries))
+        for number, wave in enumerate(self.waves):
+            tags = set(wave.get('tags', list()))
+            chosen = take(lambda server: not tags or tags & host_tags(server), wave.get('limit'))
+            waves.append((wave.get('name', 'wave %d' % (number + 1)), wave.get('parallel', self.parallel), chosen))
+        if remaining:
+            waves.append(('rest' if waves else 'all', self.parallel, remaining))
+        if self.history:
+            waves = [(wave_name, wave_parallel, self.history.order(wave_servers)) for wave_name, wave_parallel, wave_servers in waves]
+        return [wave for wave in waves if wave[2]]
+
+    def run(self, runner, servers, worker):
+        """ runs all waves on the runner, returns False if the rollout was stopped """
+        waves = self.plan(servers)
+        parallel = runner.parallel
+        first_report = len(runner.reports)
+        self._failed_before = runner.failed
+        try:
+            for number, (name, wave_parallel, chosen) in enumerate(waves):
+                if len(waves) > 1:
+                    print colorize('[wave %s: %d hosts, %d at once]' % (name, len(chosen), wave_parallel), self.color and GREEN)
+                budget = self.failure_budget
+                if name == 'canary':
+                    budget = self._failed(runner)
+                stop = None
+                if budget is not None:
+                    stop = lambda: self._failed(runner) > budget
+                runner.parallel = max(1, wave_parallel)
+                self.skipped.extend(runner.run(chosen, worker, stop))
+                if budget is not None and self._failed(runner) > budget:
+                    for later_name, later_parallel, later in waves[number + 1:]:
+                        self.skipped.extend(later)
+                    self.stopped = name
+                    return False
+            return True
+        finally:
+            runner.parallel = parallel
+            if self.history:
+                self.history.update(runner.reports[first_report:])
+                self.history.save()
+
+    def _failed(self, runner):
+        return runner.failed - self._failed_before
+
+    def summary(self):
+        """ note for the run summary, None if the rollout was complete """
+        if not self.stopped:
+            return None
+        return colorize('Rollout stopped in wave %s, failure budget exceeded, %d hosts not started: %s' % (
+            self.stopped, len(self.skipped), list_print([server.get('host') for server in self.skipped], 400)), self.color and RED)
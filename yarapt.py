@@ -2,65 +2,272 @@
 # -*- coding: utf8 -*-
 
 import sys
+import time
+import socket
 try:
     import argparse
 except ImportError:
     print "Package python-argparse is missing. Please install it."
     sys.exit(1)
 import traceback
+import cProfile
+import pstats
 try:
     import simplejson as json
 except ImportError:
     print "Package python-simplejson is missing. Please install it."
     sys.exit(1)
-from aptmachine import AptMachine
-from helpers import list_print, colorize, leet_equal_signs, print_errors
+from runner import Runner, HostReport, emit_reports, failed_hosts
+from cache import SnapshotCache
+from archives import ArchiveDepot
+from syncplan import build_index, PlanGroups, SyncPlan
+from syncplan import INSTALL, DEINSTALL, PURGE, HOLD, STATE_NAMES
+from tracer import Tracer
+from report import DriftMatrix
+from waves import load_config, WaveScheduler, RuntimeHistory
+from journal import RunJournal
+from watch import ReferenceWatcher
+from daemon import Daemon, DaemonClient, format_facts
+from relay import flatten, emit, relay
+from gather import GatheringRunner
+from helpers import list_print, colorize, utf8
 from helpers import BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE
 
-# load server connection list
-config = open('config.json')
-servers = json.load(config)
-
-# reference server has to be first one
-servers = sorted(servers, key=lambda k: k.get('reference'), reverse=True)
+# server connection list from config.json, on a relay the controller sends it
+servers, schedule = list(), dict()
+# on a relay: master list, facts and reference of the controller's sync run
+relayed_master = None
+# the task as given on the command line, relays pass it on to relays below them
+task_argv = sys.argv[1:]
 
 # fancy coloring if in a real shell
 color = False
 if sys.stdout.isatty():
     color = True
 
+def follow(args, server):
+    """ callback which prints the output of a host live, if requested """
+    if not args.follow:
+        return None
+    prefix = colorize('%s:' % server.get('host'), color and CYAN)
+    def print_line(stream, line):
+        sys.stdout.write('%s %s\n' % (prefix, line))
+    return print_line
+
+def rollout(args, task):
+    """ wave scheduler from config.json, canary and failure budget can be overridden on the command line.
+        run times are kept per task, simulated runs don't record any """
+    settings = dict(schedule)
+    if args.canary is not None:
+        settings['canary'] = args.canary
+    if args.failure_budget is not None:
+        settings['failure_budget'] = args.failure_budget
+    history = RuntimeHistory(task, recording=not getattr(args, 'simulate', False))
+    return WaveScheduler(settings, args.parallel, history, color)
+
+def task_runner(args):
+    """ runner for apt-get and command, in gather mode identical outputs are printed once with the summary """
+    if args.gather:
+        return GatheringRunner(args.parallel, color, tracer)
+    return Runner(args.parallel, color, tracer)
+
+def relay_host(runner, args, server, report, master=None):
+    """ gibt den ganzen teilbaum an das relay ab, jeder seiner rechner wird einzeln berichtet """
+    apt_cmd = runner.connect(debug=args.verbose, **server)
+    try:
+        task = {'argv': task_argv, 'parallel': server.get('parallel'), 'master': master}
+        with runner.tracer.phase(apt_cmd.host, 'relay'):
+            report.write(relay(apt_cmd, server, task, runner.finish, color))
+        # its hosts were counted one by one, unless it failed the relay itself only brings notes
+        report.counted = False
+    finally:
+        runner.release(apt_cmd)
+
+def relay_task(args):
+    """ läuft auf einem relay: auftrag und rechner kommen per stdin vom controller, jeder fertige
+        rechner geht sofort als markierte zeile zurück """
+    global servers, schedule, color, relayed_master, task_argv
+    task = utf8(json.load(sys.stdin))
+    task_argv = task['argv']
+    relayed = parser.parse_args(task_argv)
+    # canaries and the failure budget were applied by the controller to whole relays
+    relayed.canary = relayed.failure_budget = None
+    relayed.via_daemon = False
+    relayed.parallel = task.get('parallel') or relayed.parallel
+    servers, schedule = load_config(task['servers'])
+    if relayed.helper:
+        for server in servers:
+            server.setdefault('helper', True)
+    color = task.get('color', False)
+    relayed_master = task.get('master')
+    emit_reports(emit)
+    relayed.func(relayed)
+
+def delegate(args, op, **params):
+    """ hands the task to the daemon, if requested and possible. returns whether it was handled """
+    if not args.via_daemon:
+        return False
+    if schedule or args.canary is not None or args.failure_budget is not None or getattr(args, 'follow', False):
+        # waves and live output need the hosts in this process
+        print colorize('NOTE waves, canaries and --follow are not supported by the daemon, running locally', color and YELLOW)
+        return False
+    params.update(servers=flatten(servers), parallel=args.parallel, color=color, verbose=args.verbose)
+    try:
+        messages = DaemonClient(args.socket).request(op, **params)
+    except socket.error:
+        print colorize('NOTE no daemon listening on %s, running locally' % args.socket, color and YELLOW)
+        return False
+    runner = task_runner(args)
+    for message in messages:
+        if 'error' in message:
+            raise RuntimeError('yarapt daemon: %s' % message['error'])
+        runner.finish(HostReport.from_dict(message, color))
+    print runner.summary()
+    return True
+
+def daemon_task(args):
+    """ hält verbindungen und facts zwischen den aufrufen offen, bis es mit stop beendet wird """
+    if args.stop or args.status:
+        try:
+            messages = DaemonClient(args.socket).request('stop' if args.stop else 'status')
+        except socket.error:
+            print colorize('no daemon listening on %s' % args.socket, color and YELLOW)
+            return
+        for message in messages:
+            for line in message.get('lines', list()):
+                print line
+        return
+    print colorize('yarapt daemon listening on %s' % args.socket, color and GREEN)
+    Daemon(args.socket, args.idle, args.keepalive).serve()
+
+def facts_task(args):
+    """ fakten aller rechner anzeigen, über den daemon aus dessen zwischenspeicher """
+    if delegate(args, 'facts', max_age=args.max_age):
+        return
+    runner = task_runner(args)
+
+    def facts_host(server, report):
+        apt_cmd = runner.connect(debug=args.verbose, **server)
+        try:
+            report.write(format_facts(apt_cmd.gather_facts(selections=False)))
+            report.write(colorize('[OK]', color and GREEN))
+        finally:
+            runner.release(apt_cmd)
+
+    runner.run(flatten(servers), facts_host)
+    print runner.summary()
+
 def apt_task(args):
-    """ apt-get ... ausführen """
-    for server in servers:
+    """ apt-get ... ausführen. mit --two-phase laden erst alle rechner gleichzeitig die archive (apt-get -d),
+        danach wird mit der normalen parallelität installiert """
+    if not (args.two_phase or args.distribute or args.if_stale) and delegate(
+            args, 'apt', command=args.command, packages=args.packages, options=args.apt_options,
+            apt_executable=args.apt_executable, simulate=args.simulate):
+        return
+    runner = task_runner(args)
+    depot = None
+    if args.distribute and args.command in ('install', 'upgrade') and not args.simulate:
+        depot = stage_archives(runner, args, args.command, args.packages or list())
+    two_phase = args.two_phase and args.command in ('install', 'upgrade')
+    failed_downloads = set()
+
+    def apt_host(server, report, host_runner=runner, download_only=False):
+        if server.get('host') in failed_downloads:
+            report.write(colorize('[SKIPPED] download failed, nothing installed', color and RED))
+            report.ok = False
+            return
+        if server.get('relay'):
+            # a relay downloads and installs on its own
+            if not download_only:
+                relay_host(host_runner, args, server, report)
+            return
+        apt_cmd = host_runner.connect(apt_command=args.apt_executable, debug=args.verbose, simulate=args.simulate, **server)
+        options = list(args.apt_options)
         try:
-            print colorize(leet_equal_signs(server.get('host')), color and YELLOW)
-            apt_cmd = AptMachine(apt_command=args.apt_executable, debug=args.verbose, simulate=args.simulate, **server)
+            if depot and server.get('reference'):
+                options.extend(['-o', 'Dir::Cache::Archives=%s/' % depot.REMOTE_DIRECTORY])
+            elif depot:
+                if download_only or not two_phase:
+                    try:
+                        with host_runner.tracer.phase(apt_cmd.host, 'distribute'):
+                            report.write(depot.distribute(apt_cmd))
+                    except Exception, e:
+                        # apt fetches whatever is missing into the same directory
+                        report.write(colorize('WARNING archives are not distributed, apt downloads them itself: %s' % e, color and YELLOW))
+                options.extend(apt_cmd.archive_options())
             # process task to apt-get
-            print apt_cmd.execute_apt(args.command, args.packages, args.apt_options)
-            print colorize('[OK]', color and GREEN)
-        except Exception, ex:
-            print_errors(ex, color)
+            if args.command == 'update' and args.if_stale:
+                output = apt_cmd.update_if_stale(max_age=args.max_age, callback=follow(args, server))
+                if output is None:
+                    report.write(colorize('[SKIPPED] apt lists are younger than %d seconds' % args.max_age, color and GREEN))
+                    return
+                report.write(output)
+            elif download_only:
+                with host_runner.tracer.phase(apt_cmd.host, 'download'):
+                    report.write(apt_cmd.execute_apt(args.command, args.packages, options + ['-d'], follow(args, server)))
+            else:
+                with host_runner.tracer.phase(apt_cmd.host, args.command):
+                    report.write(apt_cmd.execute_apt(args.command, args.packages, options, follow(args, server)))
+            report.write(colorize('[OK]', color and GREEN))
         finally:
-            try:
-                apt_cmd.close()
-            except Exception, ex:
-                pass
+            host_runner.release(apt_cmd)
+
+    waves = rollout(args, 'apt-get-%s' % args.command)
+    try:
+        if two_phase:
+            # network-bound: every host downloads at the same time unless limited, only failures are printed
+            downloads = Runner(args.download_parallel or len(servers), color, tracer, quiet=True)
+            downloads.run(servers, lambda server, report: apt_host(server, report, downloads, True))
+            failed_downloads.update([report.host for report in downloads.reports if not report.ok])
+            print colorize('[download phase] %d hosts, %d failed, %.1fs' % (
+                len(downloads.reports), len(failed_downloads), time.time() - downloads.started), color and GREEN)
+        waves.run(runner, servers, apt_host)
+    finally:
+        if depot:
+            runner.release(depot.reference)
+    notes = [note.summary() for note in (depot, waves) if note]
+    print runner.summary(*[note for note in notes if note])
+
+def stage_archives(runner, args, command, packages=list()):
+    """ depot with archives downloaded once on the reference, None if there is no reference or it failed """
+    references = [server for server in servers if server.get('reference')]
+    if not references:
+        print colorize("Sorry, we don't have a reference server to download the archives.", color and BLUE)
+        return None
+    apt_cmd = None
+    try:
+        # the caller releases depot.reference once the run is over
+        apt_cmd = runner.connect(debug=args.verbose, **references[0])
+        depot = ArchiveDepot(apt_cmd)
+        if command != 'install' or packages:
+            with runner.tracer.phase(depot.reference.host, 'stage'):
+                depot.stage(command, packages, args.apt_options)
+        return depot
+    except Exception, e:
+        if apt_cmd:
+            runner.release(apt_cmd)
+        print colorize('WARNING archives are not distributed, every host downloads them itself: %s' % e, color and YELLOW)
+        return None
 
 def shell_task(args):
     """ eigene kommandos in der shell ausführen """
-    for server in servers:
+    if delegate(args, 'command', command=args.shell_command):
+        return
+    runner = task_runner(args)
+
+    def shell_host(server, report):
+        if server.get('relay'):
+            return relay_host(runner, args, server, report)
+        apt_cmd = runner.connect(debug=args.verbose, **server)
         try:
-            print colorize(leet_equal_signs(server.get('host')), color and YELLOW)
-            apt_cmd = AptMachine(debug=args.verbose, **server)
-            print apt_cmd._execute(args.shell_command)
-            print colorize('[OK]', color and GREEN)
-        except Exception, ex:
-            print_errors(ex, color)
+            report.write(apt_cmd._execute(args.shell_command, follow(args, server)))
+            report.write(colorize('[OK]', color and GREEN))
         finally:
-            try:
-                apt_cmd.close()
-            except Exception, ex:
-                pass
+            runner.release(apt_cmd)
+
+    waves = rollout(args, 'command')
+    waves.run(runner, servers, shell_host)
+    print runner.summary(*[note for note in [waves.summary()] if note])
 
 def sync_task(args):
     """ Sync bedeutet, die pakete von einem in einen anderen Status zu heben, wenn das vorher auf dem Masterserver auch passiert ist.
@@ -70,118 +277,383 @@ def sync_task(args):
             purge     -> install
             hold      -> install
         Im Status "unknown" tun wir nichts... vorerst :)
+        Der Referenzserver läuft zuerst, danach werden alle anderen parallel abgearbeitet.
     """
-    master_list = list()
-    master_dist = ''
-    for server in servers:
+    runner = Runner(args.parallel, color, tracer)
+    master = {'list': list(), 'index': dict(), 'dist': '', 'facts': None, 'groups': None, 'depot': None,
+              'reference': None, 'fingerprint': None}
+    cache = None
+    if args.cache:
+        cache = SnapshotCache()
+    full_lists = args.full_lists
+    # simulated runs change nothing, so they don't record anything either
+    journal = RunJournal(tracer=runner.tracer, writing=not args.simulate)
+    if args.resume and not journal.load():
+        print colorize('Nothing to resume, starting a new run.', color and BLUE)
+
+    def use_master(package_list, facts, dist, reference, fingerprint):
+        master['dist'] = dist
+        master['reference'] = reference
+        master['fingerprint'] = fingerprint
+        if not args.force_update:
+            master['facts'] = facts
+        master['list'] = package_list
+        master['index'] = build_index(package_list)
+        master['groups'] = PlanGroups(master['index'])
+
+    def resume_reference(apt_cmd, report):
+        """ master list of the interrupted run from the snapshot cache, if the reference didn't change since """
+        previous = journal.previous
+        package_list = None
+        if apt_cmd.get_fingerprint() == previous['fingerprint']:
+            package_list = cache and cache.load(apt_cmd.host, previous['fingerprint'])
+        if not package_list:
+            report.write(colorize('Reference changed since the interrupted run or is not cached, starting over.', color and YELLOW))
+            journal.forget()
+            return False
+        use_master(package_list, previous['facts'], previous['facts'].get('distribution', ''), apt_cmd.host, previous['fingerprint'])
+        journal.start(apt_cmd.host, previous['fingerprint'], previous['facts'])
+        report.write('Packages listed:', len(package_list))
+        report.write(colorize('Resuming run %s, master list taken from the snapshot cache, %d hosts finished before.' % (
+            journal.run, len(previous['finished'])), color and BLUE))
+        return True
+
+    def sync_host(server, report):
+        if server.get('relay'):
+            # the master list goes to the relay once, for its whole subtree
+            return relay_host(runner, args, server, report, dict(
+                (key, master[key]) for key in ('list', 'facts', 'dist', 'reference', 'fingerprint')))
+        apt_cmd = runner.connect(apt_command=args.apt_executable, debug=args.verbose, simulate=args.simulate, **server)
         try:
-            print colorize(leet_equal_signs(server.get('host')), color and YELLOW)
-            apt_cmd = AptMachine(apt_command=args.apt_executable, debug=args.verbose, simulate=args.simulate, **server)
-            full_lists = args.full_lists
-            package_list = apt_cmd.get_all_packages()
-            print 'Operating System:', apt_cmd.distribution
-            print 'Packages listed:', len(package_list)
+            if server.get('reference') and journal.previous and resume_reference(apt_cmd, report):
+                return
+            # targets fetch their list and run apt-get update at the same time
+            update = apt_cmd.prepare(update=not server.get('reference') and bool(master['list']) and not journal.completed(apt_cmd.host, 'update'),
+                                     cache=cache, reference_facts=master['facts'],
+                                     max_age=None if args.force_update else args.update_max_age)
+            package_list = apt_cmd.package_list
+            report.write('Operating System:', apt_cmd.distribution)
+            report.write('Packages listed:', len(package_list))
             if server.get('reference'):
-                master_dist = apt_cmd.distribution
-                print colorize('This server is reference, generating master list.', color and BLUE)
-                master_list = package_list
-            elif master_list:
-                try:
-                    print colorize('This server will now be synchronized with the master server.', color and BLUE)
-                    if apt_cmd.distribution != master_dist:
-                        print colorize("WARNING operating system differs from master server", color and YELLOW)
-                    print colorize("[01/16] (missing) unknown => install", color and GREEN)
-                    print colorize("[02/16] (missing) unknown => hold", color and GREEN)
-                    print colorize("[03/16] (missing) remove => purge", color and GREEN)
-                    print colorize("[04/16] (missing) remove => hold", color and GREEN)
-                    print colorize("[05/16] (missing) purge => hold", color and GREEN)
-                    print colorize("[06/16] (missing) hold => install", color and GREEN)
-                    print colorize("[07/16] (missing) hold => remove", color and GREEN)
-                    print colorize("[08/16] (missing) hold => purge", color and GREEN)
-                    print colorize("[09/16 apt-get update]", color and GREEN)
-                    apt_cmd.execute_apt('update')
-                    print colorize('[OK]', color and GREEN)
-                except Exception, e:
-                    print_errors(e, color)
-
-                try:
-                    missing_packages = apt_cmd.get_missing_packages(master_list)
-                    print colorize("[10/16 remove, purge => install]", color and GREEN), list_print(missing_packages, full_lists)
-                    if missing_packages:
-                        print apt_cmd.install(missing_packages)
-                        print colorize('[OK]', color and GREEN)
-                except Exception, e:
-                    print_errors(e, color)
-
-                try:
-                    redundant_packages = apt_cmd.get_redundant_packages(master_list)
-                    print colorize("[11/16 install => remove]", color and GREEN), list_print(redundant_packages, full_lists)
-                    if redundant_packages:
-                        print apt_cmd.remove(redundant_packages)
-                        print colorize('[OK]', color and GREEN)
-                except Exception, e:
-                    print_errors(e, color)
-
-                try:
-                    purged_packages = apt_cmd.get_purged_packages(master_list)
-                    print colorize("[12/16 install => purge]", color and GREEN), list_print(purged_packages, full_lists)
-                    if purged_packages:
-                        print apt_cmd.remove(purged_packages, purge=True)
-                        print colorize('[OK]', color and GREEN)
-                except Exception, e:
-                    print_errors(e, color)
-
-                try:
-                    held_packages = apt_cmd.get_hold_packages(master_list)
-                    print colorize("[13/16 install => hold]", color and GREEN), list_print(held_packages, full_lists)
-                    if held_packages:
-                        print apt_cmd.hold(held_packages)
-                        print colorize('[OK]', color and GREEN)
-                except Exception, e:
-                    print_errors(e, color)
-
-                # some cleanup tasks
-                try:
-                    print colorize("[14/16 autoremove]", color and GREEN)
-                    apt_cmd.execute_apt('autoremove')
-                    print colorize('[OK]', color and GREEN)
-                except Exception, e:
-                    print_errors(e, color)
-                try:
-                    print colorize("[15/16 clean]", color and GREEN)
-                    apt_cmd.execute_apt('clean')
-                    print colorize('[OK]', color and GREEN)
-                except Exception, e:
-                    print_errors(e, color)
-                try:
-                    print colorize("[16/16 autoclean]", color and GREEN)
-                    apt_cmd.execute_apt('autoclean')
-                    print colorize('[OK]', color and GREEN)
-                except Exception, e:
-                    print_errors(e, color)
+                report.write(colorize('This server is reference, generating master list.', color and BLUE))
+                use_master(package_list, apt_cmd.facts, apt_cmd.distribution, apt_cmd.host, apt_cmd.facts.get('fingerprint'))
+                journal.start(apt_cmd.host, apt_cmd.facts.get('fingerprint'), apt_cmd.facts)
+            elif master['list']:
+                sync_target(apt_cmd, report, update)
+                journal.host(apt_cmd.host, report.ok)
             else:
-                print colorize("Sorry, we don't have a master list to synchronize to.", color and BLUE)
-        except Exception, ex:
-            print_errors(ex, color)
-        except KeyboardInterrupt:
-            print colorize('Interrupt by user', color and RED)
-            try:
-                apt_cmd.close()
-            except Exception, ex:
-                pass
-            sys.exit(1)
+                report.write(colorize("Sorry, we don't have a master list to synchronize to.", color and BLUE))
         finally:
+            runner.release(apt_cmd)
+
+    def sync_target(apt_cmd, report, update):
+        phase = lambda name: journal.phase(apt_cmd.host, name)
+        groups = master['groups']
+
+        def pending(name, work=True):
+            # after --resume, phases the host completed before are not repeated
+            if work and journal.completed(apt_cmd.host, name):
+                report.write(colorize('[SKIPPED] completed before the interruption', color and GREEN))
+                return False
+            return bool(work)
+
+        with phase('plan'):
+            key = apt_cmd.group_key()
+            groups.join(key)
+            plan = groups.plan(key, apt_cmd.get_package_index())
+
+        def simulated(name, call):
+            # identical hosts simulate identically, the first one of a group does it for all
+            if args.simulate and args.share_simulation:
+                return groups.shared(key, name, call)
+            return call()
+        try:
+            report.write(colorize('This server will now be synchronized with the master server.', color and BLUE))
+            if apt_cmd.distribution != master['dist']:
+                report.write(colorize("WARNING operating system differs from master server", color and YELLOW))
+            report.write(colorize("[01/16] (missing) unknown => install", color and GREEN))
+            report.write(colorize("[02/16] (missing) unknown => hold", color and GREEN))
+            report.write(colorize("[03/16] (missing) remove => purge", color and GREEN))
+            report.write(colorize("[04/16] (missing) remove => hold", color and GREEN))
+            report.write(colorize("[05/16] (missing) purge => hold", color and GREEN))
+            report.write(colorize("[06/16] (missing) hold => install", color and GREEN))
+            report.write(colorize("[07/16] (missing) hold => remove", color and GREEN))
+            report.write(colorize("[08/16] (missing) hold => purge", color and GREEN))
+            report.write(colorize("[09/16 apt-get update]", color and GREEN))
+            if isinstance(update, Exception):
+                raise update
+            if journal.completed(apt_cmd.host, 'update'):
+                report.write(colorize('[SKIPPED] completed before the interruption', color and GREEN))
+            elif update is None:
+                report.write(colorize('[SKIPPED] apt lists are up to date', color and GREEN))
+            else:
+                journal.done(apt_cmd.host, 'update')
+                report.write(colorize('[OK]', color and GREEN))
+        except Exception, e:
+            report.error(e)
+
+        # archives from the reference have to be in place before anything is installed,
+        # clean and autoclean only run at the very end
+        options = list()
+        depot = master['depot']
+        if depot and plan.missing:
+            report.write(colorize('[distribute archives]', color and GREEN))
             try:
-                apt_cmd.close()
-            except Exception, ex:
-                pass
+                with phase('distribute'):
+                    depot.stage('install', plan.missing)
+                    report.write(depot.distribute(apt_cmd, plan.missing))
+                report.write(colorize('[OK]', color and GREEN))
+            except Exception, e:
+                report.write(colorize('WARNING archives are not distributed, apt downloads them itself: %s' % e, color and YELLOW))
+            options = apt_cmd.archive_options()
+
+        if args.batch:
+            # one apt-get transaction for install/remove/purge, holds via dpkg --set-selections
+            try:
+                report.write(colorize("[10/16 remove, purge => install]", color and GREEN), list_print(plan.missing, full_lists))
+                report.write(colorize("[11/16 install => remove]", color and GREEN), list_print(plan.redundant, full_lists))
+                report.write(colorize("[12/16 install => purge]", color and GREEN), list_print(plan.purged, full_lists))
+                report.write(colorize("[13/16 install => hold]", color and GREEN), list_print(plan.held, full_lists))
+                if pending('apply', len(plan)):
+                    with phase('apply'):
+                        report.write(simulated('apply', lambda: apt_cmd.apply_plan(plan, args.apt_options + options)))
+                    report.write(colorize('[OK]', color and GREEN))
+            except Exception, e:
+                report.error(e)
+        else:
+            try:
+                missing_packages = plan.missing
+                report.write(colorize("[10/16 remove, purge => install]", color and GREEN), list_print(missing_packages, full_lists))
+                if pending('install', missing_packages):
+                    with phase('install'):
+                        report.write(simulated('install', lambda: apt_cmd.install(missing_packages, options)))
+                    report.write(colorize('[OK]', color and GREEN))
+            except Exception, e:
+                report.error(e)
+
+            try:
+                redundant_packages = plan.redundant
+                report.write(colorize("[11/16 install => remove]", color and GREEN), list_print(redundant_packages, full_lists))
+                if pending('remove', redundant_packages):
+                    with phase('remove'):
+                        report.write(simulated('remove', lambda: apt_cmd.remove(redundant_packages)))
+                    report.write(colorize('[OK]', color and GREEN))
+            except Exception, e:
+                report.error(e)
+
+            try:
+                purged_packages = plan.purged
+                report.write(colorize("[12/16 install => purge]", color and GREEN), list_print(purged_packages, full_lists))
+                if pending('purge', purged_packages):
+                    with phase('purge'):
+                        report.write(simulated('purge', lambda: apt_cmd.remove(purged_packages, purge=True)))
+                    report.write(colorize('[OK]', color and GREEN))
+            except Exception, e:
+                report.error(e)
+
+            try:
+                held_packages = plan.held
+                report.write(colorize("[13/16 install => hold]", color and GREEN), list_print(held_packages, full_lists))
+                if pending('hold', held_packages):
+                    with phase('hold'):
+                        report.write(apt_cmd.hold(held_packages))
+                    report.write(colorize('[OK]', color and GREEN))
+            except Exception, e:
+                report.error(e)
+
+        # some cleanup tasks
+        for step, command in (('14/16', 'autoremove'), ('15/16', 'clean'), ('16/16', 'autoclean')):
+            try:
+                report.write(colorize("[%s %s]" % (step, command), color and GREEN))
+                if not pending(command):
+                    continue
+                with phase(command):
+                    apt_cmd.execute_apt(command)
+                report.write(colorize('[OK]', color and GREEN))
+            except Exception, e:
+                report.error(e)
+
+        # one round trip for the touched packages instead of a full listing on the next run
+        if args.simulate:
+            return
+        try:
+            report.write(colorize('[verify]', color and GREEN))
+            with phase('verify'):
+                checked = apt_cmd.verify_sync(plan.missing + plan.redundant + plan.purged + plan.held, cache)
+                left = SyncPlan(master['index'], apt_cmd.get_package_index())
+            report.write('Packages checked:', checked)
+            if len(left):
+                report.ok = False
+                for label, names in (('not installed', left.missing), ('still installed', left.redundant + left.purged), ('not held', left.held)):
+                    if names:
+                        report.write(colorize('NOT CONVERGED %s:' % label, color and RED), list_print(names, full_lists))
+            else:
+                report.write(colorize('[OK]', color and GREEN))
+        except Exception, e:
+            report.error(e)
+
+    if relayed_master and relayed_master['list']:
+        # on a relay the controller did the reference already
+        use_master(*[relayed_master[key] for key in ('list', 'facts', 'dist', 'reference', 'fingerprint')])
+        if journal.previous and journal.previous['fingerprint'] != master['fingerprint']:
+            journal.forget()
+        journal.start(master['reference'], master['fingerprint'], master['facts'])
+    # reference first, its list then fans out to all targets
+    runner.run([server for server in servers if server.get('reference')], sync_host)
+    if args.distribute and master['list'] and not args.simulate:
+        # downloads happen on demand, once per package no matter how many targets miss it
+        master['depot'] = stage_archives(runner, args, 'install')
+    targets = [server for server in servers if not server.get('reference')]
+    notes = list()
+    if journal.previous:
+        targets = [server for server in targets if not journal.finished(server.get('host'))]
+        notes.append('Resumed run %s, hosts finished before: %d' % (journal.run, len(journal.previous['finished'])))
+    waves = rollout(args, 'sync')
+    try:
+        waves.run(runner, targets, sync_host)
+    finally:
+        journal.close()
+        if master['depot']:
+            runner.release(master['depot'].reference)
+    notes.extend([note.summary() for note in (cache, master['groups'], master['depot'], waves) if note])
+    print runner.summary(*[note for note in notes if note])
+
+def watch_task(args):
+    """ hält die rechner auf dem stand des referenzservers: dessen dpkg.log wird verfolgt und nur die
+        änderungen werden verteilt. eine volle paketliste gibt es beim start und wenn sich ein rechner
+        an uns vorbei verändert hat (fingerabdruck passt nicht) """
+    runner = Runner(args.parallel, color, tracer, quiet=True)
+    cache = None
+    if args.cache:
+        cache = SnapshotCache()
+    references = [server for server in flatten(servers) if server.get('reference')]
+    if not references:
+        print colorize("Sorry, we don't have a reference server to watch.", color and BLUE)
+        return
+    targets = dict()
+
+    def sync(apt_cmd, plan):
+        """ applies a plan and remembers the target state it leads to """
+        target = targets[apt_cmd.host]
+        if len(plan):
+            apt_cmd.apply_plan(plan, args.apt_options)
+            if not args.simulate:
+                for names, state in ((plan.missing, INSTALL), (plan.redundant, DEINSTALL), (plan.purged, PURGE), (plan.held, HOLD)):
+                    target['index'].update((name, state) for name in names)
+        target['fingerprint'] = apt_cmd.get_fingerprint()
+        return len(plan)
+
+    def full_sync(apt_cmd):
+        apt_cmd.get_all_packages(cache)
+        target = targets.setdefault(apt_cmd.host, dict())
+        target['index'] = build_index(apt_cmd.package_list)
+        return sync(apt_cmd, SyncPlan(master_index, target['index']))
+
+    def start_target(server, report):
+        apt_cmd = runner.connect(apt_command=args.apt_executable, debug=args.verbose, simulate=args.simulate, **server)
+        try:
+            full_sync(apt_cmd)
+        except:
+            runner.release(apt_cmd)
+            raise
+        targets[apt_cmd.host]['apt_cmd'] = apt_cmd
+
+    def push_delta(server, report):
+        target = targets[server.get('host')]
+        apt_cmd = target['apt_cmd']
+        if apt_cmd.connection and not apt_cmd.connection.is_active():
+            report.write('Connection lost, reconnecting')
+            target['fingerprint'] = None
+            runner.release(apt_cmd)
+            apt_cmd = target['apt_cmd'] = runner.connect(apt_command=args.apt_executable, debug=args.verbose, simulate=args.simulate, **server)
+        try:
+            with runner.tracer.phase(apt_cmd.host, 'delta'):
+                if target['fingerprint'] is None:
+                    report.write('Catching up after a failure, full sync')
+                    full_sync(apt_cmd)
+                elif apt_cmd.get_fingerprint() != target['fingerprint']:
+                    # changed behind our back, the delta alone isn't enough
+                    report.write('Fingerprint changed, full sync')
+                    full_sync(apt_cmd)
+                else:
+                    sync(apt_cmd, SyncPlan(delta, target['index']))
+        except Exception:
+            # the delta would be lost, the next poll compares everything
+            target['fingerprint'] = None
+            raise
+
+    reference = runner.connect(apt_command=args.apt_executable, debug=args.verbose, **references[0])
+    try:
+        reference.get_all_packages(cache)
+        master_index = build_index(reference.package_list)
+        watcher = ReferenceWatcher(reference, master_index, args.rescan)
+        watcher.start(reference.facts.get('fingerprint'))
+        runner.run([server for server in flatten(servers) if not server.get('reference')], start_target)
+        active = [server for server in flatten(servers) if server.get('host') in targets and 'apt_cmd' in targets[server.get('host')]]
+        print colorize('Watching %s, %d packages, %d targets in line' % (reference.host, len(master_index), len(active)), color and GREEN)
+        while True:
+            time.sleep(args.interval)
+            start_time = time.time()
+            delta = watcher.poll()
+            if not delta:
+                # targets which failed before catch up without waiting for the next change
+                behind = [server for server in active if targets[server.get('host')]['fingerprint'] is None]
+                if behind:
+                    runner.run(behind, push_delta)
+                continue
+            failed_before = runner.failed
+            runner.run(active, push_delta)
+            changes = ['%s=%s' % (name, STATE_NAMES[state]) for name, state in sorted(delta.items())]
+            print colorize('[%s] %s -> %d targets in %.1fs, failed: %d' % (
+                time.strftime('%H:%M:%S'), list_print(changes, 200), len(active), time.time() - start_time,
+                runner.failed - failed_before), color and GREEN)
+    finally:
+        runner.close_all()
+
+def report_task(args):
+    """ paketzustände aller rechner als matrix, zeigt wo und wie stark von der referenz abgewichen wird """
+    runner = Runner(args.parallel, color, tracer, quiet=True)
+    matrix = DriftMatrix()
+    cache = None
+    if args.cache:
+        cache = SnapshotCache()
+
+    def report_host(server, report):
+        apt_cmd = runner.connect(debug=args.verbose, **server)
+        try:
+            apt_cmd.get_all_packages(cache)
+            matrix.add(server.get('host'), apt_cmd.get_package_index())
+        finally:
+            runner.release(apt_cmd)
+
+    # the reference has to become host number 0
+    references = [server for server in flatten(servers) if server.get('reference')]
+    runner.run(references, report_host)
+    if not matrix.hosts:
+        print colorize("Sorry, we don't have a reference server to compare with.", color and BLUE)
+        return
+    runner.run([server for server in flatten(servers) if not server.get('reference')], report_host)
+    print matrix.render(args.top)
+    if cache:
+        print runner.summary(cache.summary())
+    else:
+        print runner.summary()
 
 # komplettes parsen aller argumente mit subparsern (jeweils für sync, apt-get und command)
 parser = argparse.ArgumentParser(description='Yet Another Remote Apt Tool executes remote apt tasks :)')
 
 parser.add_argument('-v', '--verbose', action='store_true', default=False, help='enables verbose debug output')
 parser.add_argument('-c', '--color', action='store_true', default=False, help='forces colorized output')
-subparsers = parser.add_subparsers(help='"sync", "apt-get" or "command"', metavar='task')
+parser.add_argument('-p', '--parallel', type=int, default=1, help='processes up to N hosts at once (default: %(default)s)', metavar='N')
+parser.add_argument('-t', '--trace', default=None, help='appends timings of every command and phase to this JSON lines file', metavar='file')
+parser.add_argument('--timings', action='store_true', default=False, help='prints p50/p95 timings per phase at the end of the run')
+parser.add_argument('--canary', type=int, default=None, help='runs N hosts first, one at a time, and stops if any of them fails', metavar='N')
+parser.add_argument('--failure-budget', type=int, default=None, help='starts no further host once more than N hosts failed', metavar='N')
+parser.add_argument('--helper', action='store_true', default=False, help='runs commands through a persistent helper on ssh hosts, same as "helper": true in config.json')
+parser.add_argument('--via-daemon', action='store_true', default=False, help='runs apt-get and command through a running "yarapt daemon", reusing its open connections')
+parser.add_argument('--socket', default='./var/run/yarapt.sock', help='unix socket of the daemon (default: %(default)s)', metavar='path')
+parser.add_argument('--profile', action='store_true', default=False, help='runs the task under cProfile and prints the hot spots')
+subparsers = parser.add_subparsers(help='"sync", "apt-get", "watch", "facts", "report", "command" or "daemon"', metavar='task')
 
 parser_sync = subparsers.add_parser('sync', help='Synchronize your packages between all hosts')
 parser_sync.set_defaults(func=sync_task)
@@ -189,6 +661,13 @@ parser_sync.add_argument('-o', '--apt-options', nargs='+', default=list(), help=
 parser_sync.add_argument('-e', '--apt-executable', default='/usr/bin/apt-get', help='specifies another executable for apt, e.g. aptitude (default: %(default)s)', metavar='command')
 parser_sync.add_argument('-s', '--simulate', required=False, action='store_true', default=False, help='enables simulate mode, same as -o="-s"')
 parser_sync.add_argument('-l', '--full-lists', action='store_false', default=400, help='shows detailed package lists when synchronizing')
+parser_sync.add_argument('-u', '--update-max-age', type=int, default=None, help='skips apt-get update on targets whose lists are younger than this, lists equal to the reference are always skipped', metavar='seconds')
+parser_sync.add_argument('--force-update', action='store_true', default=False, help='runs apt-get update on every target, no matter how fresh its lists are')
+parser_sync.add_argument('--batch', action='store_true', default=False, help='applies all changes in one apt-get transaction, holds via dpkg --set-selections')
+parser_sync.add_argument('-g', '--share-simulation', action='store_true', default=False, help='with -s, simulates only once per group of hosts with identical packages')
+parser_sync.add_argument('--distribute', action='store_true', default=False, help='downloads missing packages once on the reference and pushes them to the targets')
+parser_sync.add_argument('-r', '--resume', action='store_true', default=False, help='continues an interrupted run: finished hosts and completed phases are skipped')
+parser_sync.add_argument('-n', '--no-cache', dest='cache', action='store_false', default=True, help='always fetches full package lists instead of using the local snapshots')
 
 parser_apt = subparsers.add_parser('apt-get', help='Executes apt-get commands on all hosts')
 parser_apt.set_defaults(func=apt_task)
@@ -197,11 +676,75 @@ parser_apt.add_argument('packages', nargs='*', default=None, help='package list
 parser_apt.add_argument('-o', '--apt-options', nargs='+', default=list(), help='list of options given for apt-get', metavar='option')
 parser_apt.add_argument('-e', '--apt-executable', default='/usr/bin/apt-get', help='specifies another executable for apt, e.g. aptitude (default: %(default)s)', metavar='command')
 parser_apt.add_argument('-s', '--simulate', required=False, action='store_true', default=False, help='enables simulate mode, same as -o="-s"')
+parser_apt.add_argument('--if-stale', action='store_true', default=False, help='update only runs if the apt lists are older than --max-age')
+parser_apt.add_argument('--max-age', type=int, default=3600, help='maximum age of the apt lists for update --if-stale (default: %(default)s)', metavar='seconds')
+parser_apt.add_argument('--distribute', action='store_true', default=False, help='install/upgrade: downloads the archives once on the reference and pushes them to the other hosts')
+parser_apt.add_argument('--two-phase', action='store_true', default=False, help='install/upgrade: downloads on all hosts at once first, then installs with --parallel hosts at a time')
+parser_apt.add_argument('--download-parallel', type=int, default=None, help='limits the download phase of --two-phase to N hosts at once (default: all)', metavar='N')
+parser_apt.add_argument('-f', '--follow', action='store_true', default=False, help='prints the output of every host live while apt-get runs')
+parser_apt.add_argument('-b', '--gather', action='store_true', default=False, help='prints identical outputs only once at the end, with a folded list of their hosts')
+
+parser_watch = subparsers.add_parser('watch', help='Follows the dpkg.log of the reference and pushes every change to all hosts')
+parser_watch.set_defaults(func=watch_task)
+parser_watch.add_argument('-o', '--apt-options', nargs='+', default=list(), help='list of options given for apt-get, e.g. -y', metavar='option')
+parser_watch.add_argument('-e', '--apt-executable', default='/usr/bin/apt-get', help='specifies another executable for apt, e.g. aptitude (default: %(default)s)', metavar='command')
+parser_watch.add_argument('-s', '--simulate', required=False, action='store_true', default=False, help='enables simulate mode, same as -o="-s"')
+parser_watch.add_argument('-i', '--interval', type=float, default=2.0, help='seconds between two looks at the reference (default: %(default)s)', metavar='seconds')
+parser_watch.add_argument('--rescan', type=int, default=300, help='compares all selections of the reference every N seconds, catches changes dpkg.log does not show (default: %(default)s)', metavar='seconds')
+parser_watch.add_argument('-n', '--no-cache', dest='cache', action='store_false', default=True, help='always fetches full package lists instead of using the local snapshots')
+
+parser_facts = subparsers.add_parser('facts', help='Shows distribution, architecture, dpkg fingerprint and apt lists of all hosts')
+parser_facts.set_defaults(func=facts_task)
+parser_facts.add_argument('--max-age', type=int, default=300, help='with --via-daemon, facts the daemon gathered up to N seconds ago are reused (default: %(default)s)', metavar='N')
+parser_facts.add_argument('-b', '--gather', action='store_true', default=False, help='prints identical outputs only once at the end, with a folded list of their hosts')
+
+parser_report = subparsers.add_parser('report', help='Shows which packages drift from the reference on how many hosts')
+parser_report.set_defaults(func=report_task)
+parser_report.add_argument('-n', '--no-cache', dest='cache', action='store_false', default=True, help='always fetches full package lists instead of using the local snapshots')
+parser_report.add_argument('--top', type=int, default=20, help='number of packages and hosts to show (default: %(default)s)', metavar='N')
+
+parser_daemon = subparsers.add_parser('daemon', help='Keeps connections open between runs, see --via-daemon')
+parser_daemon.set_defaults(func=daemon_task)
+parser_daemon.add_argument('--idle', type=int, default=600, help='closes connections unused for N seconds (default: %(default)s)', metavar='N')
+parser_daemon.add_argument('--keepalive', type=int, default=30, help='sends ssh keepalives every N seconds (default: %(default)s)', metavar='N')
+parser_daemon.add_argument('--status', action='store_true', default=False, help='lists the open connections of the running daemon')
+parser_daemon.add_argument('--stop', action='store_true', default=False, help='stops the running daemon')
+
+# internal: started by the controller on relay hosts, see relay.py
+parser_relay = subparsers.add_parser('relay')
+parser_relay.set_defaults(func=relay_task)
 
 parser_shell = subparsers.add_parser('command', help='Execute a shell command on all hosts')
 parser_shell.set_defaults(func=shell_task)
 parser_shell.add_argument('shell_command', help='executes given command at the target host shell')
+parser_shell.add_argument('-f', '--follow', action='store_true', default=False, help='prints the output of every host live while the command runs')
+parser_shell.add_argument('-b', '--gather', action='store_true', default=False, help='prints identical outputs only once at the end, with a folded list of their hosts')
 
 args = parser.parse_args()
+if args.func != relay_task:
+    # load server connection list, the reference server comes first
+    config = open('config.json')
+    servers, schedule = load_config(json.load(config))
 color = color or args.color
-args.func(args)
+if args.helper:
+    for server in servers:
+        server.setdefault('helper', True)
+tracer = Tracer(args.trace)
+try:
+    if args.profile:
+        # only the main thread is profiled, combine with -p 1 to see the work on the hosts
+        profiler = cProfile.Profile()
+        profiler.runcall(args.func, args)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+    else:
+        args.func(args)
+    # relays report their hosts one by one, a daemon serves many runs
+    if args.func not in (relay_task, daemon_task) and failed_hosts():
+        sys.exit(1)
+except KeyboardInterrupt:
+    print colorize('Interrupt by user', color and RED)
+    sys.exit(1)
+finally:
+    if args.trace or args.timings:
+        print tracer.table()
+    tracer.close()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+""" remote helper of yarapt: answers framed requests on stdin until it is closed.
+    a request is a 4 byte big endian length followed by a JSON object with an "op",
+    a response is one status byte (O or E), a 4 byte length and zlib compressed JSON.
+    runs with python 2 and 3, only the standard library is used. """
+
+import os
+import sys
+import json
+import zlib
+import struct
+import hashlib
+import subprocess
+
+VERSION = 1
+STATUS = '/var/lib/dpkg/status'
+
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+def text(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+def read_exactly(size):
+    data = b''
+    while len(data) < size:
+        chunk = stdin.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def fingerprint():
+    """ same format as AptMachine.FINGERPRINT_COMMAND: size, mtime and md5 of the dpkg database """
+    digest = hashlib.md5()
+    with open(STATUS, 'rb') as status:
+        for block in iter(lambda: status.read(65536), b''):
+            digest.update(block)
+    stat = os.stat(STATUS)
+    return '%d %d %s -' % (stat.st_size, int(stat.st_mtime), digest.hexdigest())
+
+def run(command, input=None):
+    proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    output, errors = proc.communicate(input.encode('utf-8') if input else b'')
+    return {'stdout': text(output), 'stderr': text(errors), 'returncode': proc.returncode}
+
+def op_ping(request):
+    return {'version': VERSION}
+
+def op_run(request):
+    return run(request['command'], request.get('stdin'))
+
+def op_apply(request):
+    """ runs the commands of a plan one after another, stops at the first failure """
+    results = list()
+    for command, input in request['commands']:
+        result = run(command, input)
+        results.append(result)
+        if result['returncode'] != 0:
+            break
+    return {'results': results}
+
+def op_selections(request):
+    """ dpkg selections as "name state" lines, left out if the fingerprint is still request["since"] """
+    current = fingerprint()
+    if request.get('since') == current:
+        return {'fingerprint': current, 'selections': None}
+    proc = subprocess.Popen(['/usr/bin/dpkg', '--get-selections'], stdout=subprocess.PIPE, close_fds=True)
+    output = text(proc.communicate()[0])
+    lines = [' '.join(line.split()[:2]) for line in output.split('\n') if line.strip()]
+    return {'fingerprint': current, 'selections': '\n'.join(lines)}
+
+OPERATIONS = {'ping': op_ping, 'run': op_run, 'apply': op_apply, 'selections': op_selections}
+
+def respond(status, payload):
+    data = zlib.compress(json.dumps(payload).encode('utf-8'), 6)
+    stdout.write(status + struct.pack('>I', len(data)) + data)
+    stdout.flush()
+
+def main():
+    while True:
+        header = read_exactly(4)
+        if header is None:
+            return
+        body = read_exactly(struct.unpack('>I', header)[0])
+        if body is None:
+            return
+        try:
+            request = json.loads(body.decode('utf-8'))
+            respond(b'O', OPERATIONS[request['op']](request))
+        except Exception as ex:
+            respond(b'E', {'error': '%s: %s' % (ex.__class__.__name__, ex)})
+
+if __name__ == '__main__':
+    main()